@@ -0,0 +1,266 @@
+"""
+approximate top-k search of the books with the highest predicted score x.dot(theta) + mean,
+an inverted file (ivf) index over the rows of x with exact re-ranking of the candidates
+"""
+
+__author__ = 'Antares'
+
+import numpy as np
+from collaborative_filtering import accumulate_rows, sort_exclusions
+
+
+def augment_books(x, mean):
+    """
+    map the books to unit vectors whose dot product with (theta, 1, 0) ranks them like x.dot(theta) + mean,
+    so the maximum inner product search becomes a cosine search that k-means can cluster.
+    the norm is evened out by a last column of sqrt(M^2 - |x, mean|^2), M the largest norm
+
+    @param x:
+    @param mean: per-book mean of shape (num_books,) or (num_books, 1)
+    @return: an array of shape (num_books, num_features + 2)
+    """
+    books = np.column_stack((x, np.ravel(mean))).astype(np.float64)
+    norm = np.einsum("ij,ij->i", books, books)
+    largest = max(norm.max(), np.finfo(np.float64).tiny) if norm.size else 1.0
+
+    return np.column_stack((books, np.sqrt(np.maximum(largest - norm, 0))))/np.sqrt(largest)
+
+
+def build_ivf_index(x, mean, n_lists=None, n_iter=10, seed=0, block_size=4096):
+    """
+    cluster the books with spherical k-means and build an IVFIndex
+
+    @param x:
+    @param mean: per-book mean of shape (num_books,) or (num_books, 1)
+    @param n_lists: number of clusters, None for sqrt(num_books)
+    @param n_iter: number of k-means iterations
+    @param seed:
+    @param block_size: number of books assigned at a time
+    @return: an IVFIndex
+    """
+    books = augment_books(x, mean)
+    num_books = books.shape[0]
+    if n_lists is None:
+        n_lists = int(np.sqrt(num_books))
+    n_lists = max(1, min(n_lists, num_books))
+
+    rng = np.random.RandomState(seed)
+    centroids = books[rng.choice(num_books, size=n_lists, replace=False)]
+    assignment = np.empty(num_books, dtype=np.intp)
+    for i in range(n_iter):
+        for lo in range(0, num_books, block_size):
+            assignment[lo:lo+block_size] = np.argmax(books[lo:lo+block_size].dot(centroids.T), axis=1)
+
+        centroids = accumulate_rows(assignment, books, n_lists)
+        norm = np.linalg.norm(centroids, axis=1)
+        empty = norm == 0
+        centroids[empty] = books[rng.choice(num_books, size=np.count_nonzero(empty), replace=False)]
+        norm[empty] = 1
+        centroids /= norm.reshape((-1, 1))
+
+    list_books = np.argsort(assignment, kind="stable")
+    list_offsets = np.searchsorted(assignment[list_books], np.arange(n_lists + 1))
+
+    return IVFIndex(x, mean, centroids, list_books, list_offsets)
+
+
+def recall_at_k(approximate, exact):
+    """
+    @param approximate: book indexes of shape (num_users, k)
+    @param exact: the exact top-k, of the same shape
+    @return: the mean fraction of the exact top-k that the approximate top-k found
+    """
+    if exact.size == 0:
+        return 1.0
+
+    found = (approximate[:, :, np.newaxis] == exact[:, np.newaxis, :]).any(axis=1)
+
+    return float(found.mean())
+
+
+class IVFIndex(object):
+    """
+    the books are split into lists by their nearest centroid. a query scores the centroids,
+    and only the books of its n_probe best lists are scored exactly.
+    more probes find more of the exact top-k but score more books, n_probe == n_lists is exhaustive
+    """
+    def __init__(self, x, mean, centroids, list_books, list_offsets):
+        """
+        see build_ivf_index
+
+        @param x:
+        @param mean:
+        @param centroids: unit vectors of shape (n_lists, num_features + 2), see augment_books
+        @param list_books: book indexes sorted by list
+        @param list_offsets: the books of list i are list_books[list_offsets[i]: list_offsets[i+1]]
+        """
+        self.x = x
+        self.mean = np.ravel(mean)
+        self.centroids = centroids
+        self.list_books = list_books
+        self.list_offsets = list_offsets
+        self.n_lists = centroids.shape[0]
+        # list of each book, and its position in the list
+        self.book_list = np.empty(list_books.size, dtype=np.intp)
+        self.book_list[list_books] = np.repeat(np.arange(self.n_lists), np.diff(list_offsets))
+        self.book_position = np.empty(list_books.size, dtype=np.intp)
+        self.book_position[list_books] = np.arange(list_books.size) - np.repeat(list_offsets[:-1],
+                                                                                np.diff(list_offsets))
+
+    def probe(self, theta, n_probe):
+        """
+        @param theta: queries of shape (m, num_features)
+        @param n_probe:
+        @return: the n_probe lists of each query, of shape (m, n_probe)
+        """
+        n_probe = min(n_probe, self.n_lists)
+        scores = theta.dot(self.centroids[:, :-2].T)
+        scores += self.centroids[:, -2]
+        if n_probe == self.n_lists:
+            return np.broadcast_to(np.arange(self.n_lists), scores.shape)
+
+        return np.argpartition(scores, self.n_lists - n_probe, axis=1)[:, self.n_lists - n_probe:]
+
+    def search_one(self, theta, k, n_probe, excluded_books=()):
+        """
+        @param theta: factors of one user, of shape (num_features,)
+        @param k:
+        @param n_probe:
+        @param excluded_books: book indexes that must not be returned
+        @return: book indexes and scores of the approximate top-k, sorted by descending score
+        """
+        lists = self.probe(theta.reshape((1, -1)), n_probe)[0]
+        books = np.concatenate([self.list_books[self.list_offsets[i]: self.list_offsets[i+1]] for i in lists])
+        scores = self.x[books].dot(theta)
+        scores += self.mean[books]
+        scores[np.isin(books, excluded_books)] = -np.inf
+
+        k = min(k, books.size)
+        top = np.argpartition(scores, books.size - k)[books.size - k:]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return books[top], scores[top]
+
+    def search(self, theta, k, n_probe, excluded=(), block_size=1024, user_bias=None):
+        """
+        the approximate top-k of every user, a drop-in replacement of predict_top_k.
+        the users are grouped by the lists they probe, so each list is scored as one matrix product
+
+        @param theta: factors of the users
+        @param k:
+        @param n_probe:
+        @param excluded: see predict_top_k
+        @param block_size: number of users scored against a list at a time
+        @param user_bias: see predict_top_k, it does not change the ranking and is added to the scores at the end
+        @return: book indexes and scores of shape (num_users, k), sorted by descending score.
+                 users with fewer than k candidates are padded with a score of -inf
+        """
+        num_users = theta.shape[0]
+        dtype = np.result_type(theta, self.x)
+        top_books = np.zeros((num_users, k), dtype=np.intp)
+        top_scores = np.full((num_users, k), -np.inf, dtype=dtype)
+
+        # users of each list
+        probes = self.probe(theta, n_probe)
+        probe_order = np.argsort(probes.ravel(), kind="stable")
+        probe_users = probe_order//probes.shape[1]
+        probe_offsets = np.searchsorted(probes.ravel()[probe_order], np.arange(self.n_lists + 1))
+
+        # exclusions of each list, with the position of the book in its list
+        excluded_book, excluded_user = sort_exclusions(excluded)
+        excluded_list = self.book_list[excluded_book]
+        order = np.argsort(excluded_list, kind="stable")
+        excluded_user = excluded_user[order]
+        excluded_position = self.book_position[excluded_book[order]]
+        excluded_offsets = np.searchsorted(excluded_list[order], np.arange(self.n_lists + 1))
+
+        user_row = np.full(num_users, -1, dtype=np.intp)
+        for i in range(self.n_lists):
+            books = self.list_books[self.list_offsets[i]: self.list_offsets[i+1]]
+            list_users = probe_users[probe_offsets[i]: probe_offsets[i+1]]
+            if (books.size == 0) or (list_users.size == 0):
+                continue
+            x = self.x[books]
+            mean = self.mean[books]
+            exclusion = slice(excluded_offsets[i], excluded_offsets[i+1])
+
+            for lo in range(0, list_users.size, block_size):
+                users = list_users[lo:lo+block_size]
+                p = theta[users].dot(x.T)
+                p += mean
+                user_row[users] = np.arange(users.size)
+                rows = user_row[excluded_user[exclusion]]
+                p[rows[rows >= 0], excluded_position[exclusion][rows >= 0]] = -np.inf
+                user_row[users] = -1
+
+                # merge the best k of the list with the best k so far
+                kk = min(k, books.size)
+                best = np.argpartition(p, books.size - kk, axis=1)[:, books.size - kk:]
+                candidate_books = np.concatenate((top_books[users], books[best]), axis=1)
+                candidate_scores = np.concatenate((top_scores[users], np.take_along_axis(p, best, axis=1)), axis=1)
+                best = np.argpartition(candidate_scores, kk, axis=1)[:, kk:]
+                top_books[users] = np.take_along_axis(candidate_books, best, axis=1)
+                top_scores[users] = np.take_along_axis(candidate_scores, best, axis=1)
+
+        if user_bias is not None:
+            top_scores += np.reshape(user_bias, (-1, 1))
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+
+        return np.take_along_axis(top_books, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def iter_search(self, theta, k, n_probe, excluded=(), block_size=1024, user_bias=None, users_per_search=8192):
+        """
+        search one block of users at a time, a drop-in replacement of iter_top_k.
+        bigger blocks share more of the scoring of the lists between users
+
+        @param theta: see search
+        @param k:
+        @param n_probe:
+        @param excluded:
+        @param block_size:
+        @param user_bias:
+        @param users_per_search: number of users of each block
+        @return: a generator of (lo, books, scores), see iter_top_k
+        """
+        excluded_book, excluded_user = sort_exclusions(excluded)
+        if user_bias is not None:
+            user_bias = np.reshape(user_bias, (-1, 1))
+
+        for lo in range(0, theta.shape[0], users_per_search):
+            hi = min(lo + users_per_search, theta.shape[0])
+            start, end = np.searchsorted(excluded_user, (lo, hi))
+            books, scores = self.search(theta[lo:hi], k, n_probe,
+                                        excluded=[np.column_stack((excluded_book[start:end],
+                                                                   excluded_user[start:end] - lo))],
+                                        block_size=block_size,
+                                        user_bias=None if user_bias is None else user_bias[lo:hi])
+            yield lo, books, scores
+
+    def recall(self, theta, k, n_probe, sample_size=1000, seed=0):
+        """
+        recall@k of the index against the exact top-k, without exclusions, on a sample of the users
+
+        @param theta:
+        @param k:
+        @param n_probe:
+        @param sample_size:
+        @param seed:
+        @return:
+        """
+        sample = np.random.RandomState(seed).choice(theta.shape[0], size=min(sample_size, theta.shape[0]),
+                                                    replace=False)
+        exact = theta[sample].dot(self.x.T)
+        exact += self.mean
+        k = min(k, self.x.shape[0])
+        exact = np.argpartition(exact, exact.shape[1] - k, axis=1)[:, exact.shape[1] - k:]
+        approximate, scores = self.search(theta[sample], k, n_probe)
+
+        return recall_at_k(approximate, exact)
+
+
+def main():
+    pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,688 @@
+"""
+offline benchmarks of the training code, no database is needed
+
+run the whole pipeline on a synthetic dataset and save the results as json:
+    python benchmark.py production --output results.json
+"""
+
+__author__ = 'Antares'
+
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import datetime
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+from collaborative_filtering import learn, predict_top_k, rating_biases, ENGINES
+from collaborative_filtering import cost_function, sparse_cost_function, CostFunction, SparseCostFunction
+from minimize import minimize, minimize_in_place
+from instrumentation import Instrumentation
+from ann_index import build_ivf_index, recall_at_k
+from niuread import NiureadRecommender, BackgroundWriter, assemble_recommendations, douban_prior, id_lookup
+from niuread import lookup_index
+
+# sizes of the synthetic datasets, "production" follows the size of the live tables, update it when they grow
+PRESETS = {
+    "small": dict(num_books=1000, num_users=5000, num_ratings=50000, num_recommended=20000),
+    "production": dict(num_books=10000, num_users=50000, num_ratings=500000, num_recommended=1000000),
+    "10x": dict(num_books=100000, num_users=500000, num_ratings=5000000, num_recommended=10000000),
+}
+RESULTS_DIRECTORY = "benchmark_results"
+
+
+def synthetic_ratings(num_books, num_users, density, seed=0, rank=None):
+    """
+    generate random rating triples
+
+    @param num_books:
+    @param num_users:
+    @param density: fraction of the (book, user) cells that are rated
+    @param seed:
+    @param rank: None for uniformly random scores, otherwise the scores come from a hidden model of this many
+                 features plus noise, so there is something to learn
+    @return: an array of shape (n, 3), each row is (book_index, user_index, score)
+    """
+    rng = np.random.RandomState(seed)
+    num_ratings = int(num_books*num_users*density)
+    cells = np.unique(rng.randint(0, num_books*num_users, size=num_ratings))
+    book_index, user_index = np.divmod(cells, num_users)
+    if rank is None:
+        score = rng.randint(1, 11, size=cells.size)
+    else:
+        hidden_x = rng.randn(num_books, rank)
+        hidden_theta = rng.randn(num_users, rank)
+        score = np.einsum("ij,ij->i", hidden_x[book_index], hidden_theta[user_index])*1.5/np.sqrt(rank)
+        score = np.clip(np.rint(5.5 + score + rng.randn(cells.size)*0.5), 1, 10).astype(np.int64)
+
+    return np.column_stack((book_index, user_index, score))
+
+
+def benchmark_n_jobs(num_books=20000, num_users=50000, density=0.002, num_features=10, n_iter=10,
+                     all_n_jobs=(1, 2, 4, 8)):
+    """
+    time the als engine of learn with different numbers of worker processes
+
+    @return: a list of (n_jobs, seconds)
+    """
+    ratings = synthetic_ratings(num_books, num_users, density)
+    results = []
+    reference = None
+    for n_jobs in all_n_jobs:
+        np.random.seed(0)
+        start = time.perf_counter()
+        theta, x, y_mean, cost, reg_cost = learn(shape_theta=(num_users, num_features),
+                                                 shape_x=(num_books, num_features),
+                                                 y=ratings,
+                                                 r=None,
+                                                 reg_lambda=0.5,
+                                                 n_iter=n_iter,
+                                                 engine="als",
+                                                 n_jobs=n_jobs)
+        seconds = time.perf_counter() - start
+        if reference is None:
+            reference = (theta, x)
+        identical = np.array_equal(reference[0], theta) and np.array_equal(reference[1], x)
+        print("n_jobs {:>2}: {:8.3f}s  speedup {:5.2f}  identical to n_jobs={}: {}".format(
+            n_jobs, seconds, results[0][1]/seconds if results else 1.0, all_n_jobs[0], identical))
+        assert identical, "n_jobs={} gives different factors than n_jobs={}".format(n_jobs, all_n_jobs[0])
+        results.append((n_jobs, seconds))
+
+    return results
+
+
+def measure_evaluation(f, dna, repeat):
+    """
+    @return: seconds per call, and bytes allocated at peak during one call
+    """
+    f(dna)
+    start = time.perf_counter()
+    for i in range(repeat):
+        f(dna)
+    seconds = (time.perf_counter() - start)/repeat
+
+    tracemalloc.start()
+    f(dna)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return seconds, peak
+
+
+def benchmark_cost_function(num_books=2000, num_users=5000, density=0.01, num_features=10, repeat=20):
+    """
+    time and peak allocation of one cost and gradient evaluation, the functions against the preallocated objects.
+    all of them must give the cost and gradient of the dense cost_function
+
+    @return: a dict of name: (seconds, bytes)
+    """
+    ratings = synthetic_ratings(num_books, num_users, density)
+    book_index, user_index, score = ratings[:, 0], ratings[:, 1], ratings[:, 2].astype(np.float64)
+    y = np.zeros((num_books, num_users))
+    r = np.zeros((num_books, num_users))
+    y[book_index, user_index] = score
+    r[book_index, user_index] = 1
+    shape_theta = (num_users, num_features)
+    shape_x = (num_books, num_features)
+    dna = np.random.RandomState(0).randn(num_users*num_features + num_books*num_features)
+
+    candidates = [
+        ("cost_function", lambda p: cost_function(p, shape_theta, shape_x, y, r, 0.5)),
+        ("CostFunction", CostFunction(shape_theta, shape_x, y, r, 0.5)),
+        ("sparse_cost_function", lambda p: sparse_cost_function(p, shape_theta, shape_x,
+                                                                book_index, user_index, score, 0.5)),
+        ("SparseCostFunction", SparseCostFunction(shape_theta, shape_x, book_index, user_index, score, 0.5)),
+    ]
+    results = {}
+    expected_cost, expected_grad = cost_function(dna, shape_theta, shape_x, y, r, 0.5)
+    for name, f in candidates:
+        cost, grad = f(dna)
+        assert np.isclose(cost, expected_cost) and np.allclose(grad, expected_grad), \
+            "{} does not give the cost of cost_function".format(name)
+        seconds, peak = measure_evaluation(f, dna, repeat)
+        print("{:>22}: {:10.3f} ms per call, {:12d} bytes allocated".format(name, seconds*1000, peak))
+        results[name] = (seconds, peak)
+
+    return results
+
+
+def benchmark_sparse_learn(num_books=200, num_users=500, density=0.05, num_features=5, n_iter=30):
+    """
+    learn on the dense y and r against learn on the sparse ratings, from the same starting point.
+    both must reach the same cost and factors
+
+    @return: seconds of the dense learn, seconds of the sparse learn
+    """
+    ratings = synthetic_ratings(num_books, num_users, density, rank=num_features)
+    y = np.zeros((num_books, num_users))
+    r = np.zeros((num_books, num_users))
+    y[ratings[:, 0], ratings[:, 1]] = ratings[:, 2]
+    r[ratings[:, 0], ratings[:, 1]] = 1
+
+    results = []
+    for dense in (True, False):
+        np.random.seed(0)
+        start = time.perf_counter()
+        results.append(learn(shape_theta=(num_users, num_features),
+                             shape_x=(num_books, num_features),
+                             y=y if dense else ratings,
+                             r=r if dense else None,
+                             reg_lambda=0.5,
+                             n_iter=n_iter) + (time.perf_counter() - start,))
+    (theta, x, y_mean, cost, reg_cost, seconds), (theta_s, x_s, y_mean_s, cost_s, reg_cost_s, seconds_s) = results
+    print("learn dense {:.3f}s, sparse {:.3f}s, final cost {:.6e} and {:.6e}".format(
+        seconds, seconds_s, cost[-1] if len(cost) else np.nan, cost_s[-1] if len(cost_s) else np.nan))
+    assert np.allclose(cost, cost_s) and np.allclose(theta, theta_s) and np.allclose(x, x_s) and \
+        np.allclose(y_mean, y_mean_s), "the sparse learn does not give the dense one"
+
+    return seconds, seconds_s
+
+
+def benchmark_minimize(num_books=2000, num_users=5000, density=0.01, num_features=10, n_iter=50):
+    """
+    run minimize and minimize_in_place from the same starting point, check that they evaluate exactly the same
+    points, and time them
+
+    @return: seconds of minimize, seconds of minimize_in_place
+    """
+    ratings = synthetic_ratings(num_books, num_users, density)
+    f = SparseCostFunction((num_users, num_features), (num_books, num_features),
+                           ratings[:, 0], ratings[:, 1], ratings[:, 2] - ratings[:, 2].mean(), 0.5)
+    param_0 = np.random.RandomState(0).randn(num_users*num_features + num_books*num_features)
+
+    points = []
+    start = time.perf_counter()
+    X, fX, i = minimize(lambda dna: (points.append(dna.copy()), f(dna, np.empty_like(dna)))[1], param_0, n_iter)
+    seconds = time.perf_counter() - start
+
+    points_in_place = []
+    start = time.perf_counter()
+    X_in_place, fX_in_place, i_in_place = minimize_in_place(
+        lambda dna, out: (points_in_place.append(dna.copy()), f(dna, out))[1], param_0, n_iter)
+    seconds_in_place = time.perf_counter() - start
+
+    identical = ((len(points) == len(points_in_place))
+                 and all(np.array_equal(a, b) for a, b in zip(points, points_in_place))
+                 and np.array_equal(fX, fX_in_place) and (i == i_in_place))
+    print("minimize {:.3f}s, minimize_in_place {:.3f}s, same iterates: {}".format(seconds, seconds_in_place, identical))
+    assert identical, "minimize_in_place does not evaluate the same points as minimize"
+
+    return seconds, seconds_in_place
+
+
+def benchmark_dtype(num_books=3000, num_users=10000, density=0.01, num_features=10, n_iter=100,
+                    engine="cg", k=10, min_agreement=0.9):
+    """
+    train and score the same seeded synthetic dataset in float64 and in float32, and compare time, memory and
+    the recommendations. the top-1 and the top-k of float32 must agree with float64 for min_agreement of the users,
+    which needs enough ratings per user for a well determined model and n_iter for both to converge
+
+    @return: a dict of dtype name: (training seconds, scoring seconds, peak bytes)
+    """
+    ratings = synthetic_ratings(num_books, num_users, density, rank=num_features)
+    results = {}
+    recommendations = {}
+    for dtype in (np.float64, np.float32):
+        np.random.seed(0)
+        tracemalloc.start()
+        start = time.perf_counter()
+        theta, x, y_mean, cost, reg_cost = learn(shape_theta=(num_users, num_features),
+                                                 shape_x=(num_books, num_features),
+                                                 y=ratings,
+                                                 r=None,
+                                                 reg_lambda=0.5,
+                                                 n_iter=n_iter,
+                                                 engine=engine,
+                                                 dtype=dtype)
+        training = time.perf_counter() - start
+        start = time.perf_counter()
+        top_books, top_scores = predict_top_k(theta, x, y_mean, excluded=[ratings], k=k)
+        scoring = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        name = np.dtype(dtype).name
+        print("{}: training {:.3f}s, scoring {:.3f}s, peak {} bytes, final cost {:.6e}".format(
+            name, training, scoring, peak, cost[-1] if len(cost) else np.nan))
+        results[name] = (training, scoring, peak)
+        recommendations[name] = top_books
+
+    top_1 = np.mean(recommendations["float64"][:, 0] == recommendations["float32"][:, 0])
+    overlap = np.mean([np.intersect1d(a, b).size/k for a, b in zip(recommendations["float64"],
+                                                                   recommendations["float32"])])
+    print("same top-1 for {:.1%} of users, top-{} overlap {:.1%}".format(top_1, k, overlap))
+    assert (top_1 >= min_agreement) and (overlap >= min_agreement), \
+        "float32 recommendations agree with float64 for less than {:.0%} of users".format(min_agreement)
+
+    return results
+
+
+class MockCursor(object):
+    """
+    stands in for a mysql.connector cursor, every call waits latency seconds like a network round-trip
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.rows = 0
+
+    def execute(self, query, params=None):
+        time.sleep(self.latency)
+        self.rows += 1
+
+    def executemany(self, query, seq_params):
+        time.sleep(self.latency)
+        self.rows += len(seq_params)
+
+    def close(self):
+        pass
+
+
+class MockConnection(object):
+    """
+    stands in for a mysql.connector connection
+    """
+    def __init__(self, latency=0.0002):
+        self.latency = latency
+        self.cursors = []
+
+    def cursor(self, *args, **kwargs):
+        self.cursors.append(MockCursor(self.latency))
+        return self.cursors[-1]
+
+    def commit(self):
+        time.sleep(self.latency)
+
+
+def benchmark_push(num_rows=50000, batch_sizes=(1, 100, 1000, 10000), latency=0.0002):
+    """
+    rows per second of NiureadRecommender.write_recommendations against a mock connection,
+    batch_size=1 costs one round-trip per row like the old row by row insert
+
+    @return: a list of (batch_size, rows per second)
+    """
+    rng = np.random.RandomState(0)
+    date = (datetime.datetime.today() + datetime.timedelta(1)).strftime("%Y-%m-%d")
+    recommendations = assemble_recommendations(np.arange(num_rows), np.arange(10000),
+                                               rng.randint(0, 10000, size=(num_rows, 1)),
+                                               rng.rand(num_rows, 1)*10, date)
+    recommender = NiureadRecommender()
+    results = []
+    for batch_size in batch_sizes:
+        cnx = MockConnection(latency)
+        start = time.perf_counter()
+        recommender.write_recommendations(cnx, recommendations, batch_size)
+        seconds = time.perf_counter() - start
+        assert sum(c.rows for c in cnx.cursors) == num_rows
+        print("batch size {:>6}: {:12.0f} rows/s".format(batch_size, num_rows/seconds))
+        results.append((batch_size, num_rows/seconds))
+
+    return results
+
+
+def benchmark_instrumentation(repeat=100000):
+    """
+    overhead of a stage of Instrumentation, enabled and disabled
+
+    @param repeat:
+    """
+    class NullSink(object):
+        def stage(self, name, measurements):
+            pass
+
+        def counter(self, name, value):
+            pass
+
+    for enabled in (True, False):
+        instrumentation = Instrumentation(sink=NullSink(), enabled=enabled)
+        t = time.perf_counter()
+        for _ in range(repeat):
+            with instrumentation.stage("noop"):
+                pass
+            instrumentation.count("noop", 0)
+        print("instrumentation enabled={}: {:.3f}us per stage and counter".format(
+            enabled, (time.perf_counter() - t)/repeat*1e6))
+
+
+def benchmark_ann(num_books=50000, num_users=5000, num_features=10, k=10, n_probes=(1, 4, 16, 64), seed=0):
+    """
+    recall@k and time of the approximate index against the exhaustive predict_top_k, for several n_probe
+
+    @param num_books:
+    @param num_users:
+    @param num_features:
+    @param k:
+    @param n_probes:
+    @param seed:
+    """
+    rng = np.random.RandomState(seed)
+    x = rng.randn(num_books, num_features) + 2*rng.randn(100, num_features)[rng.randint(0, 100, num_books)]
+    theta = rng.randn(num_users, num_features)
+    mean = rng.uniform(1, 5, size=(num_books, 1))
+
+    t = time.perf_counter()
+    exact, exact_score = predict_top_k(theta, x, mean, k=k)
+    print("ann: exhaustive {:.3f}s".format(time.perf_counter() - t))
+    t = time.perf_counter()
+    index = build_ivf_index(x, mean)
+    print("ann: build {} lists {:.3f}s".format(index.n_lists, time.perf_counter() - t))
+    for n_probe in n_probes:
+        t = time.perf_counter()
+        approximate, score = index.search(theta, k, n_probe)
+        print("ann: n_probe={:3d} {:.3f}s recall@{}={:.4f}".format(
+            n_probe, time.perf_counter() - t, k, recall_at_k(approximate, exact)))
+
+
+def benchmark_biases(num_books=20000, num_users=50000, num_ratings=1000000, num_features=10, k=10, seed=0):
+    """
+    time of rating_biases, and checks that with shrinkage=0 it gives the old blended mean, that a large
+    shrinkage gives the douban prior, and that the user biases are added to the scores by broadcasting
+
+    @param num_books:
+    @param num_users:
+    @param num_ratings:
+    @param num_features:
+    @param k:
+    @param seed:
+    """
+    dataset = synthetic_dataset(num_books, num_users, num_ratings, 0, seed=seed)
+    ratings = np.column_stack((lookup_index(id_lookup(dataset["book_ids"]), dataset["ratings"][:, 1]),
+                               lookup_index(id_lookup(dataset["user_ids"]), dataset["ratings"][:, 0]),
+                               dataset["ratings"][:, 2]))
+    ratings = ratings[ratings[:, 0] >= 0]
+    num_books = dataset["book_ids"].size
+    prior = douban_prior(dataset["douban"])
+
+    t = time.perf_counter()
+    item_bias, user_bias = rating_biases(ratings, num_books, num_users, prior=prior, shrinkage=5, user_shrinkage=5)
+    print("biases: {} ratings {:.3f}s".format(ratings.shape[0], time.perf_counter() - t))
+
+    count = np.bincount(ratings[:, 0], minlength=num_books).reshape((-1, 1))
+    y_mean = np.bincount(ratings[:, 0], weights=ratings[:, 2], minlength=num_books).reshape((-1, 1))
+    y_mean /= np.maximum(count, 1)
+    assert np.allclose(rating_biases(ratings, num_books, num_users, prior=prior)[0],
+                       y_mean + prior*(y_mean <= 0)), "shrinkage=0 does not give the blended mean"
+    assert np.allclose(rating_biases(ratings, num_books, num_users, prior=prior, shrinkage=1e12)[0], prior), \
+        "a large shrinkage does not give the prior"
+    assert np.allclose(item_bias, (y_mean*count + 5*prior)/(count + 5)), "the item biases are not shrunk"
+
+    rng = np.random.RandomState(seed)
+    theta = rng.randn(1000, num_features)
+    x = rng.randn(num_books, num_features)
+    prediction, score = predict_top_k(theta, x, item_bias, k=k, user_bias=user_bias[:1000])
+    dense = x.dot(theta.T) + item_bias + user_bias[:1000].T
+    assert np.allclose(score, -np.sort(-dense, axis=0)[:k].T), "predict_top_k does not add the user biases"
+    index = build_ivf_index(x, item_bias)
+    approximate, approximate_score = index.search(theta, k, index.n_lists, user_bias=user_bias[:1000])
+    assert np.allclose(approximate_score, score), "the exhaustive search does not add the user biases"
+
+
+def benchmark_pipelined_push(num_books=10000, num_users=5000, num_features=10, k=10, latency=0.02, seed=0):
+    """
+    scoring then pushing, against pushing each block from a BackgroundWriter while the next blocks are scored.
+    the pipelined time should be close to the longer of the two, not their sum
+
+    @param num_books:
+    @param num_users:
+    @param num_features:
+    @param k:
+    @param latency: seconds of each round-trip of the mock connection
+    @param seed:
+    """
+    rng = np.random.RandomState(seed)
+    theta = rng.randn(num_users, num_features)
+    x = rng.randn(num_books, num_features)
+    mean = rng.uniform(1, 5, size=(num_books, 1))
+    book_ids = np.arange(num_books)
+    user_ids = np.arange(num_users)
+    date = (datetime.datetime.today() + datetime.timedelta(1)).strftime("%Y-%m-%d")
+
+    class Recommender(NiureadRecommender):
+        NUM_RECOMMENDATIONS = k
+
+        def connect(self):
+            self.cnx = MockConnection(latency)
+            return contextlib.nullcontext(self.cnx)
+
+    recommender = Recommender()
+    start = time.perf_counter()
+    prediction, score = predict_top_k(theta, x, mean, k=k, block_size=recommender.SCORING_BLOCK_SIZE)
+    scoring = time.perf_counter() - start
+    recommendations = assemble_recommendations(user_ids, book_ids, prediction, score, date)
+    cnx = MockConnection(latency)
+    recommender.write_recommendations(cnx, recommendations, recommender.PUSH_BATCH_SIZE)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    writer = BackgroundWriter(recommender, recommender.PIPELINE_QUEUE_SIZE)
+    pipelined_prediction, pipelined_recommendations = recommender.score_blocks(theta, x, mean, None, (), None,
+                                                                               book_ids, user_ids, date, writer.put)
+    writer.close()
+    pipelined = time.perf_counter() - start
+    assert np.array_equal(pipelined_recommendations, recommendations), "the pipelined recommendations differ"
+    assert sum(c.rows for c in recommender.cnx.cursors) == recommendations.size, "rows are missing from the push"
+    print("pipelined push: scoring {:.3f}s, push {:.3f}s, sequential {:.3f}s, pipelined {:.3f}s".format(
+        scoring, sequential - scoring, sequential, pipelined))
+
+
+def import_time(module):
+    """
+    measure the import of a module in a new interpreter with -X importtime
+
+    @param module:
+    @return: the cumulative import time in seconds, and the heavy modules that were imported along
+    """
+    code = "import sys, {}; print(' '.join(m for m in ('pandas', 'mysql') if m in sys.modules))".format(module)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                             check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    microseconds = [int(line.split("|")[1]) for line in process.stderr.splitlines()
+                    if line.startswith("import time:") and line.split("|")[2].strip() == module]
+
+    return microseconds[-1]/1e6, process.stdout.split()
+
+
+def benchmark_import_time(modules=("minimize", "collaborative_filtering", "factor_store", "score", "niuread")):
+    """
+    import time of each entry point, neither of them may import pandas or mysql.connector at import time
+
+    @param modules:
+    """
+    for module in modules:
+        seconds, heavy = import_time(module)
+        print("import {}: {:.3f}s{}".format(module, seconds, ", also imports " + " ".join(heavy) if heavy else ""))
+        assert not heavy, "{} imports {} at import time".format(module, " ".join(heavy))
+
+
+def popularity(size, skew, rng):
+    """
+    zipf-like sampling weights, skew=0 is uniform, larger skew concentrates on fewer items
+
+    @param size:
+    @param skew:
+    @param rng:
+    @return: probabilities, in random order
+    """
+    weights = 1/np.arange(1, size + 1)**skew
+    rng.shuffle(weights)
+
+    return weights/weights.sum()
+
+
+def synthetic_dataset(num_books, num_users, num_ratings, num_recommended, book_skew=1.0, user_skew=0.8,
+                      rank=10, offline_fraction=0.05, douban_fraction=0.7, seed=0):
+    """
+    generate tables like the ones of the database: books with douban scores, users,
+    rating history and recommendation history, all with sparse non-contiguous ids
+
+    @param num_books:
+    @param num_users:
+    @param num_ratings: number of ratings drawn, duplicates are dropped so slightly fewer are returned
+    @param num_recommended: number of rows of recommendation history drawn
+    @param book_skew: popularity skew of books, see popularity
+    @param user_skew: activity skew of users, see popularity
+    @param rank: number of features of the hidden model the scores come from
+    @param offline_fraction: fraction of rated books that are not in the books table any more
+    @param douban_fraction: fraction of books with a douban score
+    @param seed:
+    @return: a dict of book_ids, douban, user_ids, ratings (userInfoId, bookInfoId, score)
+             and recommended (userInfoId, bookInfoId)
+    """
+    rng = np.random.RandomState(seed)
+    all_book_ids = np.sort(rng.choice(np.arange(1, 3*num_books), size=num_books, replace=False))
+    user_ids = np.sort(rng.choice(np.arange(1, 3*num_users), size=num_users, replace=False))
+    book_p = popularity(num_books, book_skew, rng)
+    user_p = popularity(num_users, user_skew, rng)
+
+    cells = np.unique(rng.choice(num_books, size=num_ratings, p=book_p)*num_users
+                      + rng.choice(num_users, size=num_ratings, p=user_p))
+    book_index, user_index = np.divmod(cells, num_users)
+    hidden_x = rng.randn(num_books, rank)
+    hidden_theta = rng.randn(num_users, rank)
+    score = np.einsum("ij,ij->i", hidden_x[book_index], hidden_theta[user_index])*1.5/np.sqrt(rank)
+    score = np.clip(np.rint(5.5 + score + rng.randn(cells.size)*0.5), 1, 10).astype(np.int64)
+    ratings = np.column_stack((user_ids[user_index], all_book_ids[book_index], score))
+    ratings = ratings[rng.permutation(ratings.shape[0])]
+
+    recommended = np.column_stack((user_ids[rng.randint(0, num_users, size=num_recommended)],
+                                   all_book_ids[rng.choice(num_books, size=num_recommended, p=book_p)]))
+
+    online = rng.rand(num_books) >= offline_fraction
+    douban = np.where(rng.rand(num_books) < douban_fraction, rng.uniform(2, 10, size=num_books), np.nan)
+
+    return dict(book_ids=all_book_ids[online], douban=douban[online], user_ids=user_ids,
+                ratings=ratings, recommended=recommended)
+
+
+class PrintSink(object):
+    """
+    prints the stages as they finish, see instrumentation.LoggingSink
+    """
+    def stage(self, name, measurements):
+        print("{:>10}: {:9.3f}s wall {:9.3f}s cpu {:14d} bytes peak".format(
+            name, measurements["seconds"], measurements["cpu_seconds"], measurements["peak_bytes"]))
+
+    def counter(self, name, value):
+        pass
+
+
+def run_pipeline(dataset, engine="cg", num_features=NiureadRecommender.NUM_FEATURES,
+                 reg_lambda=NiureadRecommender.REGULATION_LAMBDA, n_iter=NiureadRecommender.NUM_ITERATION,
+                 k=NiureadRecommender.NUM_RECOMMENDATIONS, dtype=np.float64, seed=0):
+    """
+    run the stages of NiureadRecommender.recommend on a synthetic dataset, with a mock connection for the write
+
+    @param dataset: see synthetic_dataset
+    @return: stage measurements and counters
+    """
+    recorder = Instrumentation(sink=PrintSink(), trace_memory=True)
+    num_books = dataset["book_ids"].size
+    num_users = dataset["user_ids"].size
+
+    with recorder.stage("ingest"):
+        book_lookup = id_lookup(dataset["book_ids"])
+        user_lookup = id_lookup(dataset["user_ids"])
+        indexed = []
+        for rows in (dataset["ratings"], dataset["recommended"]):
+            rows = np.column_stack((lookup_index(book_lookup, rows[:, 1]),
+                                    lookup_index(user_lookup, rows[:, 0]),
+                                    rows[:, 2:]))
+            indexed.append(rows[(rows[:, 0] >= 0) & (rows[:, 1] >= 0)])
+        indexed_rating, indexed_recommendation = indexed
+
+    with recorder.stage("biases"):
+        biases = rating_biases(indexed_rating, num_books, num_users, prior=douban_prior(dataset["douban"]),
+                               shrinkage=NiureadRecommender.BIAS_SHRINKAGE,
+                               user_shrinkage=NiureadRecommender.USER_BIAS_SHRINKAGE)
+
+    with recorder.stage("optimise"):
+        np.random.seed(seed)
+        theta, x, y_mean, cost, reg_cost = learn(shape_theta=(num_users, num_features),
+                                                 shape_x=(num_books, num_features),
+                                                 y=indexed_rating,
+                                                 r=None,
+                                                 reg_lambda=reg_lambda,
+                                                 n_iter=n_iter,
+                                                 engine=engine,
+                                                 dtype=dtype,
+                                                 biases=biases)
+
+    with recorder.stage("score"):
+        prediction, top_score = predict_top_k(theta, x, y_mean, excluded=[indexed_recommendation, indexed_rating],
+                                              k=k, dtype=dtype, user_bias=biases[1])
+
+    with recorder.stage("write"):
+        recommendations = assemble_recommendations(dataset["user_ids"], dataset["book_ids"], prediction, top_score,
+                                                   "2000-01-01")
+        NiureadRecommender().write_recommendations(MockConnection(latency=0), recommendations,
+                                                   NiureadRecommender.PUSH_BATCH_SIZE)
+
+    counters = dict(rows_read=int(dataset["ratings"].shape[0] + dataset["recommended"].shape[0]),
+                    ratings=int(indexed_rating.shape[0]), users=num_users, books=num_books,
+                    iterations=int(len(cost)), final_cost=float(cost[-1]) if len(cost) else None,
+                    recommendations=int(recommendations.size))
+
+    return dict(stages=recorder.stages, counters=counters)
+
+
+def run_suite(preset, engine="cg", dtype="float64", output=None):
+    """
+    generate the dataset of a preset, run the pipeline and save the results as json
+
+    @param preset: a key of PRESETS
+    @param engine: see collaborative_filtering.learn
+    @param dtype:
+    @param output: path of the json file, None for RESULTS_DIRECTORY/<preset>-<time>.json
+    @return: the results
+    """
+    print("generating the {} dataset".format(preset))
+    dataset = synthetic_dataset(**PRESETS[preset])
+    results = dict(preset=preset,
+                   config=dict(PRESETS[preset], engine=engine, dtype=dtype),
+                   time=datetime.datetime.now().isoformat(timespec="seconds"),
+                   python=platform.python_version(),
+                   numpy=np.__version__,
+                   machine=platform.machine(),
+                   cpu_count=os.cpu_count())
+    results.update(run_pipeline(dataset, engine=engine, dtype=np.dtype(dtype)))
+
+    if output is None:
+        os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+        output = os.path.join(RESULTS_DIRECTORY, "{}-{}.json".format(
+            preset, datetime.datetime.now().strftime("%Y%m%d-%H%M%S")))
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("results saved to {}".format(output))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="offline benchmarks, no database is needed")
+    parser.add_argument("preset", nargs="?", default="small", choices=sorted(PRESETS))
+    parser.add_argument("--engine", default="cg", choices=sorted(ENGINES))
+    parser.add_argument("--dtype", default="float64", choices=("float64", "float32"))
+    parser.add_argument("--output", help="path of the json results, defaults to {}/".format(RESULTS_DIRECTORY))
+    parser.add_argument("--micro", action="store_true", help="run the micro benchmarks instead")
+    args = parser.parse_args(argv)
+
+    if args.micro:
+        benchmark_n_jobs()
+        benchmark_cost_function()
+        benchmark_sparse_learn()
+        benchmark_minimize()
+        benchmark_dtype()
+        benchmark_push()
+        benchmark_instrumentation()
+        benchmark_ann()
+        benchmark_biases()
+        benchmark_pipelined_push()
+        benchmark_import_time()
+    else:
+        run_suite(args.preset, engine=args.engine, dtype=args.dtype, output=args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,15 @@
 __author__ = 'Antares'
 
+import os
+import time
+import shutil
+import tempfile
+import concurrent.futures
 import numpy as np
-from minimize import minimize
+from minimize import minimize_in_place
+
+ENGINES = ("cg", "als", "sgd", "adagrad", "adam")
+DEFAULT_LEARNING_RATES = {"sgd": 0.01, "adagrad": 0.1, "adam": 0.01}
 
 
 def fold(dna, shape_theta, shape_x):
@@ -14,25 +22,33 @@ def fold(dna, shape_theta, shape_x):
     @return:
     """
     # check length
-    assert dna.size == np.product(shape_theta) + np.product(shape_x)
-    theta = dna[0: np.product(shape_theta)].reshape(shape_theta)
-    x = dna[np.product(shape_theta):].reshape(shape_x)
+    assert dna.size == np.prod(shape_theta) + np.prod(shape_x)
+    theta = dna[0: np.prod(shape_theta)].reshape(shape_theta)
+    x = dna[np.prod(shape_theta):].reshape(shape_x)
 
     return theta, x
 
 
-def unfold(theta, x):
+def unfold(theta, x, dtype=None):
     """
     convert theta and x into a 1-dimension dna
     @param theta:
     @param x:
+    @param dtype: dtype of the dna, None to keep the dtype of theta and x
     @return:
     """
-    return np.concatenate((theta.flatten(), x.flatten()))
+    dna = np.concatenate((theta.flatten(), x.flatten()))
+    if dtype is not None:
+        dna = dna.astype(dtype, copy=False)
+
+    return dna
 
 
-def cost_function(dna, shape_theta, shape_x, y, r, reg_lambda):
+def cost_function(dna, shape_theta, shape_x, y, r, reg_lambda, dtype=None):
     theta, x = fold(dna, shape_theta, shape_x)
+    if dtype is not None:  # integer y and r would promote float32 to float64
+        y = y.astype(dtype, copy=False)
+        r = r.astype(dtype, copy=False)
 
     # cost
     d = (x.dot(theta.T)-y) * r
@@ -46,7 +62,678 @@ def cost_function(dna, shape_theta, shape_x, y, r, reg_lambda):
     return cost, grad
 
 
-def learn(shape_theta, shape_x, y, r, reg_lambda, n_iter):
+def to_triples(ratings):
+    """
+    convert sparse ratings into (book_index, user_index, score) arrays
+
+    @param ratings: a scipy.sparse matrix of shape (num_books, num_users), an array of shape (n, 3)
+                    with rows of (book_index, user_index, score), or a tuple of the three arrays
+    @return: book_index, user_index, score
+    """
+    if hasattr(ratings, "tocoo"):
+        ratings = ratings.tocoo()
+        book_index, user_index, score = ratings.row, ratings.col, ratings.data
+    elif isinstance(ratings, np.ndarray):
+        book_index, user_index, score = ratings[:, 0], ratings[:, 1], ratings[:, 2]
+    else:
+        book_index, user_index, score = ratings
+
+    return (np.asarray(book_index, dtype=np.intp),
+            np.asarray(user_index, dtype=np.intp),
+            np.asarray(score, dtype=np.float64))
+
+
+def accumulate_rows(index, values, num_rows):
+    """
+    sum the rows of values into a (num_rows, k) array, row values[j] goes to row index[j].
+    this is the sparse equivalent of r.dot(values) without building r
+
+    @param index:
+    @param values:
+    @param num_rows:
+    @return:
+    """
+    out = np.empty((num_rows, values.shape[1]), dtype=values.dtype)
+    for k in range(values.shape[1]):
+        out[:, k] = np.bincount(index, weights=values[:, k], minlength=num_rows)
+
+    return out
+
+
+def sparse_cost_function(dna, shape_theta, shape_x, book_index, user_index, score, reg_lambda, dtype=None):
+    """
+    same as cost_function, but only the observed (book_index, user_index, score) entries are evaluated,
+    so time and memory grow with the number of ratings instead of books x users
+
+    @param dna:
+    @param shape_theta:
+    @param shape_x:
+    @param book_index:
+    @param user_index:
+    @param score:
+    @param reg_lambda:
+    @param dtype: see cost_function
+    @return:
+    """
+    theta, x = fold(dna, shape_theta, shape_x)
+    if dtype is not None:
+        score = score.astype(dtype, copy=False)
+    x_rated = x[book_index]
+    theta_rated = theta[user_index]
+
+    # cost
+    d = np.einsum("ij,ij->i", x_rated, theta_rated) - score
+    cost = (1/2)*np.sum(d**2) + (reg_lambda/2)*np.sum(theta**2) + (reg_lambda/2)*np.sum(x**2)
+
+    # gradient
+    theta_gradient = accumulate_rows(user_index, d[:, np.newaxis]*x_rated, shape_theta[0]) + reg_lambda*theta
+    x_gradient = accumulate_rows(book_index, d[:, np.newaxis]*theta_rated, shape_x[0]) + reg_lambda*x
+    grad = np.concatenate((theta_gradient.flatten(), x_gradient.flatten()))
+
+    return cost, grad
+
+
+class CostFunction(object):
+    """
+    cost_function with preallocated workspaces. theta and x are views into the dna, and the gradient is
+    written into a flat buffer, so an evaluation allocates no arrays
+    """
+    def __init__(self, shape_theta, shape_x, y, r, reg_lambda, dtype=np.float64):
+        """
+
+        @param shape_theta:
+        @param shape_x:
+        @param y: normalized ratings
+        @param r:
+        @param reg_lambda:
+        @param dtype: dtype of the dna and of all buffers
+        """
+        self.shape_theta = tuple(shape_theta)
+        self.shape_x = tuple(shape_x)
+        self.size_theta = int(np.prod(shape_theta))
+        self.y = np.asarray(y, dtype=dtype)
+        self.r = np.asarray(r, dtype=dtype)
+        self.reg_lambda = reg_lambda
+
+        self.d = np.empty(self.y.shape, dtype=dtype)
+        self.grad = np.empty(self.size_theta + int(np.prod(shape_x)), dtype=dtype)
+        self.product = np.empty_like(self.grad)
+        self.theta_product, self.x_product = self.split(self.product)
+
+    def split(self, dna):
+        """
+        fold without copying or checking
+
+        @param dna:
+        @return: theta, x
+        """
+        return dna[:self.size_theta].reshape(self.shape_theta), dna[self.size_theta:].reshape(self.shape_x)
+
+    def __call__(self, dna, out=None):
+        """
+
+        @param dna:
+        @param out: where the gradient is written, defaults to a buffer that is overwritten by the next call
+        @return: cost, grad
+        """
+        if out is None:
+            out = self.grad
+        theta, x = self.split(dna)
+
+        # cost
+        np.dot(x, theta.T, out=self.d)
+        self.d -= self.y
+        self.d *= self.r
+        cost = (1/2)*np.vdot(self.d, self.d) + (self.reg_lambda/2)*np.vdot(dna, dna)
+
+        # gradient
+        np.dot(self.d.T, x, out=self.theta_product)
+        np.dot(self.d, theta, out=self.x_product)
+        np.multiply(dna, self.reg_lambda, out=out)
+        out += self.product
+
+        return cost, out
+
+
+class SparseCostFunction(CostFunction):
+    """
+    sparse_cost_function with preallocated workspaces. the ratings are sorted by user, and the sums over users
+    and books are done with np.add.reduceat into buffers, so an evaluation allocates no arrays
+    """
+    def __init__(self, shape_theta, shape_x, book_index, user_index, score, reg_lambda, dtype=np.float64):
+        """
+
+        @param shape_theta:
+        @param shape_x:
+        @param book_index:
+        @param user_index:
+        @param score: normalized score
+        @param reg_lambda:
+        @param dtype: dtype of the dna and of all buffers
+        """
+        self.shape_theta = tuple(shape_theta)
+        self.shape_x = tuple(shape_x)
+        self.size_theta = int(np.prod(shape_theta))
+        self.reg_lambda = reg_lambda
+
+        order = np.argsort(user_index, kind="stable")
+        self.book_index = np.ascontiguousarray(book_index[order])
+        self.user_index = np.ascontiguousarray(user_index[order])
+        self.score = np.asarray(score[order], dtype=dtype)
+        self.by_book = np.argsort(self.book_index, kind="stable")
+        self.user_starts, self.user_rated = self.segments(self.user_index, shape_theta[0], dtype)
+        self.book_starts, self.book_rated = self.segments(self.book_index[self.by_book], shape_x[0], dtype)
+
+        num_ratings = self.score.size
+        num_features = shape_theta[1]
+        self.x_rated = np.empty((num_ratings, num_features), dtype=dtype)
+        self.theta_rated = np.empty((num_ratings, num_features), dtype=dtype)
+        self.d = np.empty(num_ratings, dtype=dtype)
+        # one extra row of zeros, so reduceat can start a segment at num_ratings
+        self.weighted = np.zeros((num_ratings + 1, num_features), dtype=dtype)
+        self.weighted_by_book = np.zeros((num_ratings + 1, num_features), dtype=dtype)
+
+        self.grad = np.empty(self.size_theta + int(np.prod(shape_x)), dtype=dtype)
+        self.product = np.empty_like(self.grad)
+        self.theta_product, self.x_product = self.split(self.product)
+
+    @staticmethod
+    def segments(index, num_rows, dtype):
+        """
+
+        @param index: sorted row index of each rating
+        @param num_rows:
+        @param dtype: dtype of the mask
+        @return: the first rating of each row, and a (num_rows, 1) mask of rows that have ratings
+        """
+        starts = np.searchsorted(index, np.arange(num_rows))
+        rated = (np.bincount(index, minlength=num_rows) > 0).astype(dtype).reshape((-1, 1))
+
+        return starts, rated
+
+    def __call__(self, dna, out=None):
+        """
+
+        @param dna:
+        @param out: where the gradient is written, defaults to a buffer that is overwritten by the next call
+        @return: cost, grad
+        """
+        if out is None:
+            out = self.grad
+        theta, x = self.split(dna)
+        num_ratings = self.score.size
+        weighted = self.weighted[:num_ratings]
+
+        # cost, the indexes are known to be valid and mode="raise" would make take copy into a temporary
+        np.take(x, self.book_index, axis=0, out=self.x_rated, mode="clip")
+        np.take(theta, self.user_index, axis=0, out=self.theta_rated, mode="clip")
+        np.einsum("ij,ij->i", self.x_rated, self.theta_rated, out=self.d)
+        self.d -= self.score
+        cost = (1/2)*np.vdot(self.d, self.d) + (self.reg_lambda/2)*np.vdot(dna, dna)
+
+        # gradient, a row without ratings gets a stray value from reduceat that the mask clears
+        np.multiply(self.d[:, np.newaxis], self.x_rated, out=weighted)
+        np.add.reduceat(self.weighted, self.user_starts, axis=0, out=self.theta_product)
+        self.theta_product *= self.user_rated
+
+        np.multiply(self.d[:, np.newaxis], self.theta_rated, out=weighted)
+        np.take(weighted, self.by_book, axis=0, out=self.weighted_by_book[:num_ratings], mode="clip")
+        np.add.reduceat(self.weighted_by_book, self.book_starts, axis=0, out=self.x_product)
+        self.x_product *= self.book_rated
+
+        np.multiply(dna, self.reg_lambda, out=out)
+        out += self.product
+
+        return cost, out
+
+
+def solve_factors(fixed, own_index, fixed_index, score, num_rows, reg_lambda, chunk_size=16384):
+    """
+    closed-form ridge solve of every row of one factor matrix while the other one is fixed.
+    the rows are solved in blocks of less than 2 * chunk_size ratings, so memory is bounded by
+    chunk_size * num_features**2 however many ratings there are
+
+    a block holds whole rows, a row with more than chunk_size ratings is a block of its own and its normal
+    equations are summed chunk_size ratings at a time from its first rating. so the result of a row only
+    depends on its own ratings, and not on where the ratings given to this function start, see ShardedSolver
+
+    @param fixed: the fixed factor matrix, x when solving theta and theta when solving x
+    @param own_index: row index of each rating in the factor being solved, sorted
+    @param fixed_index: row index of each rating in the fixed factor
+    @param score:
+    @param num_rows: number of rows of the factor being solved
+    @param reg_lambda:
+    @param chunk_size:
+    @return: the solved factor matrix, of shape (num_rows, num_features)
+    """
+    num_features = fixed.shape[1]
+    dtype = np.result_type(fixed, score)
+    regulation = reg_lambda*np.eye(num_features, dtype=dtype)
+    offsets = np.searchsorted(own_index, np.arange(num_rows + 1))
+
+    # blocks start at the row of every chunk_size-th rating, and around the rows with more ratings than that
+    large = np.flatnonzero(np.diff(offsets) > chunk_size)
+    bounds = np.unique(np.concatenate((np.searchsorted(offsets, np.arange(0, own_index.size, chunk_size),
+                                                       side="right") - 1,
+                                       large, large + 1, [0, num_rows])))
+
+    out = np.empty((num_rows, num_features), dtype=dtype)
+    for row_lo, row_hi in zip(bounds[:-1], bounds[1:]):
+        a = np.zeros((row_hi - row_lo, num_features, num_features), dtype=dtype)
+        b = np.zeros((row_hi - row_lo, num_features), dtype=dtype)
+        # blocks of several rows have less than 2 * chunk_size ratings and are summed at once
+        step = chunk_size if row_hi - row_lo == 1 else max(offsets[row_hi] - offsets[row_lo], 1)
+        for lo in range(offsets[row_lo], offsets[row_hi], step):
+            hi = min(lo + step, offsets[row_hi])
+            rows = own_index[lo:hi] - row_lo
+            fixed_rated = fixed[fixed_index[lo:hi]]
+            first = np.flatnonzero(np.diff(rows, prepend=-1))
+            a[rows[first]] += np.add.reduceat(np.einsum("ij,ik->ijk", fixed_rated, fixed_rated), first, axis=0)
+            b[rows[first]] += np.add.reduceat(score[lo:hi, np.newaxis]*fixed_rated, first, axis=0)
+        a += regulation
+        out[row_lo:row_hi] = np.linalg.solve(a, b[:, :, np.newaxis])[:, :, 0]
+
+    return out
+
+
+def als(theta, x, book_index, user_index, score, reg_lambda, n_iter, n_jobs=1,
+        tol=None, gtol=None, max_time=None, callback=None):
+    """
+    alternating least squares, each sweep solves theta with x fixed and then x with theta fixed.
+    minimizes the same cost as sparse_cost_function
+
+    the ratings are sorted by user and by book once, so the rows can be cut into shards of contiguous
+    ratings. the result does not depend on n_jobs
+
+    @param theta: initial theta
+    @param x: initial x
+    @param book_index:
+    @param user_index:
+    @param score:
+    @param reg_lambda:
+    @param n_iter: number of sweeps
+    @param n_jobs: number of worker processes, 1 to solve everything in this process
+    @param tol: stop when a sweep improves the cost by less than this fraction, None to always run n_iter sweeps
+    @param gtol: not used, the gradient is not computed by als
+    @param max_time: wall-clock budget in seconds, checked before each sweep, None to disable
+    @param callback: called after each sweep as callback(sweep, cost, nan, sweep), like the callback of minimize,
+                     the run ends if it returns True
+    @return: theta, x, and the cost after each sweep
+    """
+    by_user = np.argsort(user_index, kind="stable")
+    by_book = np.argsort(book_index, kind="stable")
+    by_user = (user_index[by_user], book_index[by_user], score[by_user])
+    by_book = (book_index[by_book], user_index[by_book], score[by_book])
+
+    if n_jobs == 1:
+        solver = None
+    else:
+        solver = ShardedSolver(n_jobs, theta, x, by_user, by_book)
+        theta, x = solver.theta, solver.x
+
+    deadline = None if max_time is None else time.perf_counter() + max_time
+    fX = []
+    try:
+        for i in range(n_iter):
+            if (deadline is not None) and (time.perf_counter() >= deadline):
+                break
+            if solver is None:
+                theta = solve_factors(x, by_user[0], by_user[1], by_user[2], theta.shape[0], reg_lambda)
+                x = solve_factors(theta, by_book[0], by_book[1], by_book[2], x.shape[0], reg_lambda)
+            else:
+                solver.solve(reg_lambda)
+
+            d = np.einsum("ij,ij->i", x[book_index], theta[user_index]) - score
+            fX.append((1/2)*np.sum(d**2) + (reg_lambda/2)*np.sum(theta**2) + (reg_lambda/2)*np.sum(x**2))
+            if (callback is not None) and callback(i + 1, fX[-1], float("nan"), i + 1):
+                break
+            if (tol is not None) and (i > 0) and (fX[-2] - fX[-1] <= tol*abs(fX[-2])):
+                break
+    finally:
+        if solver is not None:
+            theta, x = np.array(theta), np.array(x)
+            solver.close()
+
+    return theta, x, np.array(fX)
+
+
+class ShardedSolver(object):
+    """
+    runs the theta and x half-sweeps of als in a process pool, each task solves a shard of rows.
+    the factors and the sorted ratings live in memory-mapped .npy files in a temporary directory,
+    so a task only carries file names and row ranges, and workers write their rows in place
+    """
+    SHARDS_PER_JOB = 4
+
+    def __init__(self, n_jobs, theta, x, by_user, by_book):
+        """
+
+        @param n_jobs: number of worker processes
+        @param theta: initial theta
+        @param x: initial x
+        @param by_user: (user_index, book_index, score) sorted by user
+        @param by_book: (book_index, user_index, score) sorted by book
+        """
+        self.directory = tempfile.mkdtemp(prefix="niuread_als_")
+        self.theta = self.share("theta", theta)
+        self.x = self.share("x", x)
+        self.by_user = [self.share("by_user_{}".format(i), a) for i, a in enumerate(by_user)]
+        self.by_book = [self.share("by_book_{}".format(i), a) for i, a in enumerate(by_book)]
+        self.user_shards = self.make_shards(by_user[0], theta.shape[0], n_jobs*self.SHARDS_PER_JOB)
+        self.book_shards = self.make_shards(by_book[0], x.shape[0], n_jobs*self.SHARDS_PER_JOB)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs)
+
+    def share(self, name, array):
+        """
+        copy an array into a memory-mapped .npy file
+
+        @param name:
+        @param array:
+        @return: the memory-mapped array
+        """
+        path = os.path.join(self.directory, name + ".npy")
+        shared = np.lib.format.open_memmap(path, mode="w+", dtype=array.dtype, shape=array.shape)
+        shared[...] = array
+
+        return shared
+
+    @staticmethod
+    def make_shards(own_index, num_rows, num_shards):
+        """
+        cut rows into shards holding about the same number of ratings
+
+        @param own_index: sorted row index of each rating
+        @param num_rows:
+        @param num_shards:
+        @return: a list of (first_row, last_row + 1, first_rating, last_rating + 1)
+        """
+        offsets = np.searchsorted(own_index, np.arange(num_rows + 1))
+        bounds = np.searchsorted(offsets, np.linspace(0, own_index.size, num_shards + 1))
+        bounds = np.unique(np.concatenate(([0], np.minimum(bounds, num_rows), [num_rows])))
+
+        return [(lo, hi, offsets[lo], offsets[hi]) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+    def solve(self, reg_lambda):
+        """
+        one als sweep, theta first and then x
+
+        @param reg_lambda:
+        """
+        self.run(self.x, self.theta, self.by_user, self.user_shards, reg_lambda)
+        self.run(self.theta, self.x, self.by_book, self.book_shards, reg_lambda)
+
+    def run(self, fixed, out, ratings, shards, reg_lambda):
+        paths = [a.filename for a in [fixed, out] + ratings]
+        futures = [self.executor.submit(solve_shard, *paths, *shard, reg_lambda) for shard in shards]
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+_shared_arrays = {}
+
+
+def open_shared(path, mode="r+"):
+    """
+    open a memory-mapped .npy file, once per worker process
+
+    @param path:
+    @param mode: "r+" for arrays the worker writes, "r" for read-only
+    @return:
+    """
+    if (path, mode) not in _shared_arrays:
+        _shared_arrays[path, mode] = np.load(path, mmap_mode=mode)
+
+    return _shared_arrays[path, mode]
+
+
+def solve_shard(fixed_path, out_path, own_path, fixed_index_path, score_path, lo, hi, start, end, reg_lambda):
+    """
+    worker task of ShardedSolver, solves rows lo to hi of the output factor
+
+    @return:
+    """
+    own_index = open_shared(own_path)[start:end] - lo
+    fixed_index = open_shared(fixed_index_path)[start:end]
+    score = open_shared(score_path)[start:end]
+
+    out = open_shared(out_path)
+    out[lo:hi] = solve_factors(open_shared(fixed_path), own_index, fixed_index, score, hi - lo, reg_lambda)
+
+
+def inverse_decay(learning_rate, decay):
+    """
+    learning rate schedule learning_rate / (1 + decay * epoch), for the stochastic engines of learn
+
+    @param learning_rate:
+    @param decay:
+    @return: a function of the epoch
+    """
+    return lambda epoch: learning_rate/(1 + decay*epoch)
+
+
+def exponential_decay(learning_rate, gamma):
+    """
+    learning rate schedule learning_rate * gamma ** epoch, for the stochastic engines of learn
+
+    @param learning_rate:
+    @param gamma:
+    @return: a function of the epoch
+    """
+    return lambda epoch: learning_rate*gamma**epoch
+
+
+def batch_gradient(index, values, factors, counts, reg_lambda):
+    """
+    gradient of a mini-batch with respect to the rows of one factor matrix that it touches.
+    the regularization of a row is split evenly over its ratings, so the batch gradients of an epoch
+    add up to the full gradient
+
+    @param index: row of each rating of the batch
+    @param values: gradient of the squared error of each rating with respect to its row
+    @param factors:
+    @param counts: number of ratings of each row in the whole training set
+    @param reg_lambda:
+    @return: the rows touched, and their gradient
+    """
+    rows, inverse = np.unique(index, return_inverse=True)
+    grad = np.zeros((rows.size, values.shape[1]), dtype=values.dtype)
+    np.add.at(grad, inverse, values)
+    grad += (reg_lambda*np.bincount(inverse)/counts[rows])[:, np.newaxis]*factors[rows]
+
+    return rows, grad
+
+
+class StochasticStep(object):
+    """
+    parameter update of one factor matrix for the engines "sgd", "adagrad" and "adam".
+    only the rows touched by a batch are updated, adagrad and adam keep their statistics per entry
+    """
+    BETA_1 = 0.9
+    BETA_2 = 0.999
+    EPSILON = 1e-8
+
+    def __init__(self, method, factors):
+        self.method = method
+        self.factors = factors
+        self.t = 0
+        if method in ("adagrad", "adam"):
+            self.v = np.zeros_like(factors)
+        if method == "adam":
+            self.m = np.zeros_like(factors)
+
+    def __call__(self, rows, grad, learning_rate):
+        self.t += 1
+        if self.method == "sgd":
+            self.factors[rows] -= learning_rate*grad
+        elif self.method == "adagrad":
+            self.v[rows] += grad**2
+            self.factors[rows] -= learning_rate*grad/(np.sqrt(self.v[rows]) + self.EPSILON)
+        else:
+            self.m[rows] = self.BETA_1*self.m[rows] + (1 - self.BETA_1)*grad
+            self.v[rows] = self.BETA_2*self.v[rows] + (1 - self.BETA_2)*grad**2
+            m_hat = self.m[rows]/(1 - self.BETA_1**self.t)
+            v_hat = self.v[rows]/(1 - self.BETA_2**self.t)
+            self.factors[rows] -= learning_rate*m_hat/(np.sqrt(v_hat) + self.EPSILON)
+
+
+def stochastic(theta, x, book_index, user_index, score, reg_lambda, n_iter, method="sgd", learning_rate=None,
+               batch_size=1024, tol=None, gtol=None, max_time=None, callback=None):
+    """
+    mini-batch stochastic gradient descent on the cost of sparse_cost_function. every epoch shuffles the ratings
+    and takes one step per batch of batch_size ratings, so a step only touches the ratings of its batch
+
+    @param theta: initial theta, updated in place
+    @param x: initial x, updated in place
+    @param book_index:
+    @param user_index:
+    @param score:
+    @param reg_lambda:
+    @param n_iter: number of epochs
+    @param method: "sgd", "adagrad" or "adam"
+    @param learning_rate: a number, or a function of the epoch such as inverse_decay,
+                          None for the default of the method
+    @param batch_size:
+    @param tol: stop when an epoch improves the cost by less than this fraction, None to always run n_iter epochs
+    @param gtol: not used
+    @param max_time: wall-clock budget in seconds, checked before each epoch, None to disable
+    @param callback: called after each epoch as callback(epoch, cost, nan, number of steps),
+                     the run ends if it returns True
+    @return: theta, x, and the cost after each epoch
+    """
+    if learning_rate is None:
+        learning_rate = DEFAULT_LEARNING_RATES[method]
+    schedule = learning_rate if callable(learning_rate) else (lambda epoch: learning_rate)
+
+    user_counts = np.bincount(user_index, minlength=theta.shape[0])
+    book_counts = np.bincount(book_index, minlength=x.shape[0])
+    theta_step = StochasticStep(method, theta)
+    x_step = StochasticStep(method, x)
+
+    deadline = None if max_time is None else time.perf_counter() + max_time
+    fX = []
+    for epoch in range(n_iter):
+        if (deadline is not None) and (time.perf_counter() >= deadline):
+            break
+
+        rate = schedule(epoch)
+        order = np.random.permutation(score.size)
+        for start in range(0, score.size, batch_size):
+            batch = order[start: start+batch_size]
+            batch_book = book_index[batch]
+            batch_user = user_index[batch]
+            x_rated = x[batch_book]
+            theta_rated = theta[batch_user]
+            d = np.einsum("ij,ij->i", x_rated, theta_rated) - score[batch]
+
+            user_rows, theta_gradient = batch_gradient(batch_user, d[:, np.newaxis]*x_rated, theta,
+                                                       user_counts, reg_lambda)
+            book_rows, x_gradient = batch_gradient(batch_book, d[:, np.newaxis]*theta_rated, x,
+                                                   book_counts, reg_lambda)
+            theta_step(user_rows, theta_gradient, rate)
+            x_step(book_rows, x_gradient, rate)
+
+        d = np.einsum("ij,ij->i", x[book_index], theta[user_index]) - score
+        fX.append((1/2)*np.sum(d**2) + (reg_lambda/2)*np.sum(theta**2) + (reg_lambda/2)*np.sum(x**2))
+        if (callback is not None) and callback(epoch + 1, fX[-1], float("nan"), theta_step.t):
+            break
+        if (tol is not None) and (epoch > 0) and (fX[-2] - fX[-1] <= tol*abs(fX[-2])):
+            break
+
+    return theta, x, np.array(fX)
+
+
+def initial_params(shape_theta, shape_x, initial=None, dtype=np.float64):
+    """
+    the starting point of the optimization
+
+    @param shape_theta:
+    @param shape_x:
+    @param initial: (theta, x) from a previous run, or None for random values
+    @param dtype:
+    @return: 1-dimension dna
+    """
+    if initial is None:
+        return np.random.randn(np.prod(shape_theta) + np.prod(shape_x)).astype(dtype, copy=False)
+
+    theta, x = initial
+    assert (theta.shape == tuple(shape_theta)) and (x.shape == tuple(shape_x))
+    return unfold(theta, x, dtype)
+
+
+def warm_start_factors(old_ids, old_factors, new_ids):
+    """
+    carry the rows of a factor matrix learned in a previous run over to the current ids.
+    rows of new ids are freshly initialized, rows of ids that no longer exist are dropped
+
+    @param old_ids: the id of each row of old_factors
+    @param old_factors:
+    @param new_ids: the id of each row of the returned factors
+    @return: factors of shape (len(new_ids), num_features)
+    """
+    old_ids = np.asarray(old_ids)
+    new_ids = np.asarray(new_ids)
+    factors = np.random.randn(new_ids.size, old_factors.shape[1])
+    if old_ids.size == 0:
+        return factors
+
+    order = np.argsort(old_ids)
+    position = order[np.minimum(np.searchsorted(old_ids, new_ids, sorter=order), old_ids.size - 1)]
+    found = old_ids[position] == new_ids
+    factors[found] = old_factors[position[found]]
+
+    return factors
+
+
+def learn(shape_theta, shape_x, y, r, reg_lambda, n_iter, engine="cg", n_jobs=1, initial=None,
+          tol=None, gtol=None, max_time=None, callback=None, learning_rate=None, batch_size=1024, dtype=np.float64,
+          biases=None):
+    """
+    learn theta and x from the ratings
+
+    @param shape_theta: (num_users, num_features)
+    @param shape_x: (num_books, num_features)
+    @param y: dense (num_books, num_users) rating matrix, or, if r is None, the sparse ratings accepted
+              by to_triples
+    @param r: dense (num_books, num_users) 0/1 matrix marking the rated entries of y,
+              or None to train on sparse ratings
+    @param reg_lambda:
+    @param n_iter: max number of line searches for "cg", number of sweeps for "als",
+                   number of epochs for the stochastic engines
+    @param engine: "cg" to optimize with minimize, "als" for alternating least squares,
+                   or "sgd", "adagrad" or "adam" for mini-batch stochastic gradient descent.
+                   all but "cg" run on the sparse ratings
+    @param n_jobs: number of worker processes for the per-user and per-book solves of "als"
+    @param initial: (theta, x) to warm-start from, None to start from random values
+    @param tol: stop when an iteration improves the cost by less than this fraction, None to run n_iter iterations
+    @param gtol: stop when the gradient norm falls below this, None to disable. not used by "als"
+    @param max_time: wall-clock budget of the optimization in seconds, None to disable
+    @param callback: called after each iteration as callback(i, cost, |gradient|, n_evals), see minimize
+    @param learning_rate: a number or a schedule such as inverse_decay, for the stochastic engines,
+                          None for the default of the engine
+    @param batch_size: number of ratings per step of the stochastic engines
+    @param dtype: floating point type of the training, np.float32 halves memory and bandwidth
+    @param biases: (item_bias, user_bias) made by rating_biases, subtracted from the ratings instead of the
+                   mean of each book, None for the mean. item_bias is returned as y_mean, the user_bias
+                   has to be added to the predictions by the caller
+    @return: theta, x, y_mean, cost, reg_cost, theta, x and y_mean are of dtype
+    """
+    if engine not in ENGINES:
+        raise ValueError("unknown engine {}, should be one of {}".format(engine, ENGINES))
+    stopping = dict(tol=tol, gtol=gtol, max_time=max_time, callback=callback)
+    options = dict(engine=engine, n_jobs=n_jobs, initial=initial, learning_rate=learning_rate, batch_size=batch_size,
+                   dtype=dtype, biases=biases)
+
+    if r is None:
+        return learn_sparse(shape_theta, shape_x, y, reg_lambda, n_iter, **options, **stopping)
+    if (engine != "cg") or (biases is not None):
+        book_index, user_index = np.nonzero(r)
+        return learn_sparse(shape_theta, shape_x, (book_index, user_index, y[book_index, user_index]),
+                            reg_lambda, n_iter, **options, **stopping)
+
     num_movies = y.shape[0]
     num_users = y.shape[1]
 
@@ -54,15 +741,16 @@ def learn(shape_theta, shape_x, y, r, reg_lambda, n_iter):
     y_sum = y.sum(axis=1)
     r_sum = r.sum(axis=1)
     r_sum += (r_sum<=0)
-    y_mean = (y_sum/r_sum).reshape((-1, 1))
-    y = y - y_mean.dot(np.ones((1, num_users)))
+    y_mean = (y_sum/r_sum).reshape((-1, 1)).astype(dtype)
+    y = y - y_mean.dot(np.ones((1, num_users), dtype=dtype))
 
-    param_0 = np.random.randn(np.product(shape_theta) + np.product(shape_x))
+    param_0 = initial_params(shape_theta, shape_x, initial, dtype)
 
     # optimize
-    opt, cost, i = minimize(lambda dna: cost_function(dna, shape_theta, shape_x, y, r, reg_lambda),
-                            param_0,
-                            n_iter)
+    opt, cost, i = minimize_in_place(CostFunction(shape_theta, shape_x, y, r, reg_lambda, dtype),
+                                     param_0,
+                                     n_iter,
+                                     **stopping)
 
     theta, x = fold(opt, shape_theta, shape_x)
     reg_cost = (reg_lambda/2)*np.sum(theta**2) + (reg_lambda/2)*np.sum(x**2)
@@ -70,6 +758,209 @@ def learn(shape_theta, shape_x, y, r, reg_lambda, n_iter):
     return theta, x, y_mean, cost, reg_cost
 
 
+def normalize_ratings(book_index, score, num_books, dtype=np.float64):
+    """
+    subtract the mean score of each book from the sparse ratings, books without ratings have a mean of 0
+
+    @param book_index:
+    @param score:
+    @param num_books:
+    @param dtype:
+    @return: normalized score, y_mean of shape (num_books, 1)
+    """
+    y_sum = np.bincount(book_index, weights=score, minlength=num_books)
+    r_sum = np.bincount(book_index, minlength=num_books)
+    r_sum += (r_sum<=0)
+    y_mean = (y_sum/r_sum).reshape((-1, 1))
+
+    return (score - y_mean[book_index, 0]).astype(dtype), y_mean.astype(dtype)
+
+
+def rating_biases(ratings, num_books, num_users, prior=None, shrinkage=0.0, user_shrinkage=None):
+    """
+    item biases shrunk towards a prior, and optionally user biases, in one pass over the sparse ratings:
+        item_bias[b] = (sum of the scores of b + shrinkage*prior[b]) / (number of scores of b + shrinkage)
+        user_bias[u] = sum of (score - item_bias[b]) of u / (number of scores of u + user_shrinkage)
+    books without ratings get their prior. with shrinkage=0 the item bias of a rated book is its mean score
+
+    @param ratings: see to_triples
+    @param num_books:
+    @param num_users:
+    @param prior: per-book prior of shape (num_books, 1) or (num_books,), such as the douban prior, None for 0
+    @param shrinkage: weight of the prior in number of ratings
+    @param user_shrinkage: the same for the user biases, None for no user biases
+    @return: item_bias of shape (num_books, 1), user_bias of shape (num_users, 1) or None
+    """
+    book_index, user_index, score = to_triples(ratings)
+    prior = np.zeros(num_books) if prior is None else np.ravel(prior)
+
+    book_sum = np.bincount(book_index, weights=score, minlength=num_books) + shrinkage*prior
+    book_count = np.bincount(book_index, minlength=num_books) + shrinkage
+    item_bias = np.where(book_count > 0, book_sum/np.maximum(book_count, np.finfo(np.float64).tiny), prior)
+    item_bias = item_bias.reshape((-1, 1))
+    if user_shrinkage is None:
+        return item_bias, None
+
+    residual = score - item_bias[book_index, 0]
+    user_count = np.bincount(user_index, minlength=num_users) + user_shrinkage
+    user_bias = np.bincount(user_index, weights=residual, minlength=num_users)/np.maximum(user_count, 1)
+
+    return item_bias, user_bias.reshape((-1, 1))
+
+
+def learn_sparse(shape_theta, shape_x, ratings, reg_lambda, n_iter, engine="cg", n_jobs=1, initial=None,
+                 tol=None, gtol=None, max_time=None, callback=None, learning_rate=None, batch_size=1024,
+                 dtype=np.float64, biases=None):
+    """
+    the sparse training path of learn, y and r are never densified
+
+    @param shape_theta: (num_users, num_features)
+    @param shape_x: (num_books, num_features)
+    @param ratings: see to_triples
+    @param reg_lambda:
+    @param n_iter:
+    @param engine: see learn
+    @param n_jobs: see learn
+    @param initial: see learn
+    @param tol: see learn
+    @param gtol: see learn
+    @param max_time: see learn
+    @param callback: see learn
+    @param learning_rate: see learn
+    @param batch_size: see learn
+    @param dtype: see learn
+    @param biases: see learn
+    @return: theta, x, y_mean, cost, reg_cost
+    """
+    stopping = dict(tol=tol, gtol=gtol, max_time=max_time, callback=callback)
+    book_index, user_index, score = to_triples(ratings)
+    num_books = shape_x[0]
+
+    # Normalize Ratings
+    if biases is None:
+        score, y_mean = normalize_ratings(book_index, score, num_books, dtype)
+    else:
+        y_mean, user_bias = biases
+        score = score - y_mean[book_index, 0]
+        if user_bias is not None:
+            score -= user_bias[user_index, 0]
+        score = score.astype(dtype, copy=False)
+        y_mean = np.asarray(y_mean, dtype=dtype)
+
+    param_0 = initial_params(shape_theta, shape_x, initial, dtype)
+
+    # optimize
+    if engine == "als":
+        theta, x = fold(param_0, shape_theta, shape_x)
+        theta, x, cost = als(theta, x, book_index, user_index, score, reg_lambda, n_iter, n_jobs, **stopping)
+    elif engine != "cg":
+        theta, x = fold(param_0, shape_theta, shape_x)
+        theta, x, cost = stochastic(theta, x, book_index, user_index, score, reg_lambda, n_iter, engine,
+                                    learning_rate, batch_size, **stopping)
+    else:
+        opt, cost, i = minimize_in_place(SparseCostFunction(shape_theta, shape_x,
+                                                            book_index, user_index, score, reg_lambda, dtype),
+                                         param_0,
+                                         n_iter,
+                                         **stopping)
+        theta, x = fold(opt, shape_theta, shape_x)
+
+    reg_cost = (reg_lambda/2)*np.sum(theta**2) + (reg_lambda/2)*np.sum(x**2)
+
+    return theta, x, y_mean, cost, reg_cost
+
+
+def sort_exclusions(excluded):
+    """
+    merge exclusions and sort them by user
+
+    @param excluded: see predict_top_k
+    @return: book_index and user_index of the exclusions, sorted by user_index
+    """
+    excluded = [np.asarray(e, dtype=np.intp) for e in excluded] + [np.empty((0, 2), dtype=np.intp)]
+    excluded_book = np.concatenate([e[:, 0] for e in excluded])
+    excluded_user = np.concatenate([e[:, 1] for e in excluded])
+    order = np.argsort(excluded_user, kind="stable")
+
+    return excluded_book[order], excluded_user[order]
+
+
+def predict_top_k(theta, x, mean, excluded=(), k=1, block_size=1024, dtype=None, user_bias=None):
+    """
+    find the k books with the highest predicted score for every user.
+    users are scored in blocks of block_size, so the full books x users prediction matrix is never built
+    and peak memory depends on block_size * num_books
+
+    @param theta:
+    @param x:
+    @param mean: per-book mean of shape (num_books, 1) or (num_books,), added by broadcasting
+    @param excluded: a list of integer arrays of shape (n, 2) or wider, the first two columns are the
+                     (book_index, user_index) of entries that must not be recommended
+    @param k: number of books per user
+    @param block_size: number of users scored at a time
+    @param dtype: dtype of the scoring, None for the dtype of theta and x
+    @param user_bias: per-user bias of shape (num_users, 1) or (num_users,) added by broadcasting, None for 0
+    @return: book indices and scores, both of shape (num_users, k), sorted by descending score.
+             excluded books get a score of -inf
+    """
+    num_users = theta.shape[0]
+    k = min(k, x.shape[0])
+    if dtype is None:
+        dtype = np.result_type(theta, x)
+
+    top_books = np.empty((num_users, k), dtype=np.intp)
+    top_scores = np.empty((num_users, k), dtype=dtype)
+    for lo, books, scores in iter_top_k(theta, x, mean, excluded, k, block_size, dtype, user_bias):
+        top_books[lo:lo+books.shape[0]] = books
+        top_scores[lo:lo+books.shape[0]] = scores
+
+    return top_books, top_scores
+
+
+def iter_top_k(theta, x, mean, excluded=(), k=1, block_size=1024, dtype=None, user_bias=None):
+    """
+    predict_top_k one block of users at a time, so each block can be used as soon as it is scored
+
+    @param theta: see predict_top_k
+    @param x:
+    @param mean:
+    @param excluded:
+    @param k:
+    @param block_size:
+    @param dtype:
+    @param user_bias:
+    @return: a generator of (lo, books, scores), the top-k of the users lo to lo + len(books)
+    """
+    num_users = theta.shape[0]
+    num_books = x.shape[0]
+    k = min(k, num_books)
+    if dtype is None:
+        dtype = np.result_type(theta, x)
+    theta = theta.astype(dtype, copy=False)
+    x = x.astype(dtype, copy=False)
+    mean = np.reshape(mean, (1, -1)).astype(dtype, copy=False)
+    if user_bias is not None:
+        user_bias = np.reshape(user_bias, (-1, 1)).astype(dtype, copy=False)
+
+    # sort the exclusions by user, so each block takes a contiguous slice
+    excluded_book, excluded_user = sort_exclusions(excluded)
+
+    for lo in range(0, num_users, block_size):
+        hi = min(lo + block_size, num_users)
+
+        p = theta[lo:hi].dot(x.T)
+        p += mean
+        if user_bias is not None:
+            p += user_bias[lo:hi]
+        start, end = np.searchsorted(excluded_user, (lo, hi))
+        p[excluded_user[start:end] - lo, excluded_book[start:end]] = -np.inf
+
+        books = np.argpartition(p, num_books - k, axis=1)[:, num_books - k:]
+        scores = np.take_along_axis(p, books, axis=1)
+        order = np.argsort(-scores, axis=1, kind="stable")
+        yield lo, np.take_along_axis(books, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
 def main():
     pass
 
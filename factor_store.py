@@ -0,0 +1,228 @@
+"""
+a read-only store of the learned factors, to score users on demand between the batch runs.
+the arrays are memory mapped, so the worker processes of a server share one copy in the page cache,
+and opening a store neither trains nor imports pandas or mysql
+
+usage:
+    store = FactorStore("factor_store")
+    book_ids, scores = store.top_k(user_id, k=10)
+"""
+
+__author__ = 'Antares'
+
+import os
+import shutil
+import datetime
+import functools
+import numpy as np
+from collaborative_filtering import sort_exclusions
+from training_cache import load_mapped
+from ann_index import IVFIndex
+
+CURRENT_FILE = "CURRENT"
+ARRAYS = ("theta", "x", "x_norm", "mean", "user_bias", "book_ids", "user_ids", "book_lookup", "user_lookup",
+          "excluded_indptr", "excluded_books")
+ANN_ARRAYS = ("ann_centroids", "ann_list_books", "ann_list_offsets")  # only in stores written with an index
+
+
+def write_factor_store(directory, theta, x, mean, book_ids, user_ids, book_lookup, user_lookup, excluded=(),
+                       index=None, user_bias=None, keep=2):
+    """
+    write a new version of the store and make it the current one. stores that are open keep
+    the version they opened, so the old files are only removed once keep newer versions exist
+
+    @param directory:
+    @param theta:
+    @param x:
+    @param mean: per-book mean, the douban prior included
+    @param book_ids: bookInfoId of each row of x
+    @param user_ids: userInfoId of each row of theta
+    @param book_lookup: see niuread.id_lookup
+    @param user_lookup: see niuread.id_lookup
+    @param excluded: the (book_index, user_index) that are never recommended, see predict_top_k
+    @param index: an ann_index.IVFIndex of x, stored for the approximate top_k
+    @param user_bias: per-user bias, None for 0
+    @param keep: number of versions kept
+    @return: path of the new version
+    """
+    excluded_book, excluded_user = sort_exclusions(excluded)
+    arrays = dict(theta=theta,
+                  x=x,
+                  x_norm=np.linalg.norm(x, axis=1),
+                  mean=np.ravel(mean).astype(x.dtype),
+                  user_bias=np.zeros(theta.shape[0], dtype=x.dtype) if user_bias is None else
+                  np.ravel(user_bias).astype(x.dtype),
+                  book_ids=book_ids,
+                  user_ids=user_ids,
+                  book_lookup=book_lookup,
+                  user_lookup=user_lookup,
+                  excluded_indptr=np.searchsorted(excluded_user, np.arange(theta.shape[0] + 1)),
+                  excluded_books=excluded_book)
+    names = ARRAYS
+    if index is not None:
+        arrays.update(ann_centroids=index.centroids, ann_list_books=index.list_books,
+                      ann_list_offsets=index.list_offsets)
+        names = ARRAYS + ANN_ARRAYS
+
+    version = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    path = os.path.join(directory, version)
+    os.makedirs(path)
+    for name in names:
+        np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(arrays[name]))
+
+    current_path = os.path.join(directory, CURRENT_FILE)
+    with open(current_path + ".tmp", "w") as f:
+        f.write(version)
+    os.replace(current_path + ".tmp", current_path)
+
+    versions = sorted(d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d)))
+    for old in versions[:-keep]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+
+    return path
+
+
+def top_k(scores, k):
+    """
+    @param scores: a 1-d array, excluded entries are -inf
+    @param k:
+    @return: indexes and scores of the k highest scores, sorted by descending score
+    """
+    k = min(k, scores.size)
+    index = np.argpartition(scores, scores.size - k)[scores.size - k:]
+    index = index[np.argsort(-scores[index], kind="stable")]
+
+    return index, scores[index]
+
+
+class FactorStore(object):
+    """
+    scores users and books from the current version of a store written by write_factor_store.
+    the top-k lists of the last cache_size users are kept in an lru cache
+    """
+    def __init__(self, directory, cache_size=1024, n_probe=None):
+        """
+
+        @param directory:
+        @param cache_size: number of (user_id, k) kept in the cache, 0 for no cache
+        @param n_probe: lists probed by top_k when the store has an approximate index, None to score every book
+        """
+        self.directory = directory
+        self.cache_size = cache_size
+        self.n_probe = n_probe
+        self.version = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        switch to the current version if a newer one has been written, the cache is cleared when it does
+
+        @return: True if the version changed
+        """
+        with open(os.path.join(self.directory, CURRENT_FILE)) as f:
+            version = f.read().strip()
+        if version == self.version:
+            return False
+
+        path = os.path.join(self.directory, version)
+        for name in ARRAYS:
+            setattr(self, name, load_mapped(os.path.join(path, name + ".npy")))
+        self.index = None
+        if os.path.exists(os.path.join(path, ANN_ARRAYS[0] + ".npy")):
+            self.index = IVFIndex(self.x, self.mean,
+                                  *[load_mapped(os.path.join(path, name + ".npy")) for name in ANN_ARRAYS])
+        self.version = version
+        self.cached_top_k = functools.lru_cache(maxsize=self.cache_size)(self.compute_top_k)
+
+        return True
+
+    def user_index(self, user_id):
+        index = self.user_lookup[user_id] if 0 <= user_id < self.user_lookup.size else -1
+        if index < 0:
+            raise KeyError("unknown user {}".format(user_id))
+
+        return index
+
+    def book_index(self, book_id):
+        index = self.book_lookup[book_id] if 0 <= book_id < self.book_lookup.size else -1
+        if index < 0:
+            raise KeyError("unknown book {}".format(book_id))
+
+        return index
+
+    def score_user(self, user_id):
+        """
+        predicted score of every book for a user, one matrix-vector product
+
+        @param user_id: userInfoId
+        @return: an array of shape (num_books,), excluded books are not removed
+        """
+        user_index = self.user_index(user_id)
+        scores = self.x.dot(self.theta[user_index])
+        scores += self.mean
+        scores += self.user_bias[user_index]
+
+        return scores
+
+    def top_k(self, user_id, k=10, excluded_book_ids=()):
+        """
+        the k books with the highest predicted score for a user, without the books rated or recommended
+        before the last run. results without excluded_book_ids come from the cache
+
+        @param user_id: userInfoId
+        @param k:
+        @param excluded_book_ids: bookInfoId of more books to exclude
+        @return: bookInfoId and score of the books, sorted by descending score. read-only when cached
+        """
+        if len(excluded_book_ids) == 0:
+            return self.cached_top_k(user_id, k)
+
+        return self.compute_top_k(user_id, k, excluded_book_ids)
+
+    def compute_top_k(self, user_id, k, excluded_book_ids=()):
+        user_index = self.user_index(user_id)
+        excluded = np.concatenate((self.excluded_books[self.excluded_indptr[user_index]:
+                                                       self.excluded_indptr[user_index + 1]],
+                                   [self.book_index(book_id) for book_id in excluded_book_ids])).astype(np.intp)
+        if (self.index is not None) and (self.n_probe is not None):
+            index, scores = self.index.search_one(self.theta[user_index], k, self.n_probe, excluded)
+            scores += self.user_bias[user_index]
+        else:
+            scores = self.score_user(user_id)
+            scores[excluded] = -np.inf
+            index, scores = top_k(scores, k)
+        book_ids = self.book_ids[index]
+        book_ids.flags.writeable = False
+        scores.flags.writeable = False
+
+        return book_ids, scores
+
+    def more_like_this(self, book_id, k=10, user_id=None):
+        """
+        the k books whose factors are the most similar to those of a book, by cosine similarity
+
+        @param book_id: bookInfoId
+        @param k:
+        @param user_id: userInfoId, to also exclude the books rated or recommended to the user
+        @return: bookInfoId and similarity of the books, sorted by descending similarity
+        """
+        book_index = self.book_index(book_id)
+        similarity = self.x.dot(self.x[book_index])
+        similarity /= np.maximum(self.x_norm*self.x_norm[book_index], np.finfo(similarity.dtype).tiny)
+        similarity[book_index] = -np.inf
+        if user_id is not None:
+            user_index = self.user_index(user_id)
+            similarity[self.excluded_books[self.excluded_indptr[user_index]: self.excluded_indptr[user_index + 1]]] \
+                = -np.inf
+
+        index, similarity = top_k(similarity, k)
+
+        return self.book_ids[index], similarity
+
+
+def main():
+    pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+timing and memory instrumentation of the stages of a run
+"""
+
+__author__ = 'Antares'
+
+import time
+import logging
+import contextlib
+import tracemalloc
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+class LoggingSink(object):
+    """
+    the default sink of Instrumentation, sends the measurements to a logger.
+    any object with the methods stage(name, measurements) and counter(name, value) can be used instead
+    """
+    def __init__(self, log=logger, level=logging.INFO):
+        self.log = log
+        self.level = level
+
+    def stage(self, name, measurements):
+        self.log.log(self.level, "stage {}: {}".format(
+            name, ", ".join(("{}={:.6g}" if isinstance(value, float) else "{}={}").format(key, value)
+                            for key, value in measurements.items())))
+
+    def counter(self, name, value):
+        self.log.log(self.level, "counter {}: {}".format(name, value))
+
+
+class Instrumentation(object):
+    """
+    measures wall time, cpu time and memory of stages, and keeps counters.
+    every measurement is kept in self.stages and self.counters and sent to the sink.
+    when disabled, stage returns a shared no-op context and count returns at once
+    """
+    DISABLED_STAGE = contextlib.nullcontext()
+
+    def __init__(self, sink=None, enabled=True, trace_memory=False, prefix=""):
+        """
+
+        @param sink: see LoggingSink, None for a LoggingSink
+        @param enabled: False to turn off all the measurements
+        @param trace_memory: also record the tracemalloc peak of each stage, this slows down
+                             allocation heavy code. stages should not be nested when it is on
+        @param prefix: added to the names of the stages and counters
+        """
+        self.sink = LoggingSink() if sink is None else sink
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.prefix = prefix
+        self.stages = {}
+        self.counters = {}
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+
+    def stage(self, name):
+        """
+        usage:
+            with instrumentation.stage("score"):
+                ...
+
+        @param name:
+        @return: a context manager that measures the code it wraps
+        """
+        if not self.enabled:
+            return self.DISABLED_STAGE
+
+        return self.measure(self.prefix + name)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if self.trace_memory:
+            if tracing:
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            measurements = dict(seconds=time.perf_counter() - wall, cpu_seconds=time.process_time() - cpu)
+            if self.trace_memory:
+                measurements["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+                if not tracing:
+                    tracemalloc.stop()
+            if resource is not None:
+                # ru_maxrss is the peak of the whole process so far, in KiB on linux
+                measurements["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+            self.stages[name] = measurements
+            self.sink.stage(name, measurements)
+
+    def count(self, name, value):
+        """
+        set a counter
+
+        @param name:
+        @param value:
+        """
+        if not self.enabled:
+            return
+
+        self.counters[self.prefix + name] = value
+        self.sink.counter(self.prefix + name, value)
+
+
+def main():
+    pass
+
+
+if __name__ == "__main__":
+    main()
@@ -48,18 +48,26 @@
 # 1) translated original code into Python by Yue Cao, 2015
 # 2) removed input arguments p1, p2, p3, p4, p5
 # 3) add default length = 100
+# 4) add optional tol, stop when a line search improves the function value by less than this fraction
+# 5) add minimize_in_place, the same algorithm with reused work vectors and plain float line search maths
+# 6) add optional gtol, max_time and callback, see stop_early
 
 """
 this module contains a straight forward python translation of Carl Edward Rasmussen's original
 U{minimize.m, http://www.gatsby.ucl.ac.uk/~edward/code/minimize/minimize.m}
 """
 
+import math
+import time
+import logging
 import numpy as np
 from numpy.lib.scimath import sqrt
 
+logger = logging.getLogger(__name__)
+
 
 # # function [X, fX, i] = minimize(X, f, length, P1, P2, P3, P4, P5);
-def minimize(f, X, length=100):
+def minimize(f, X, length=100, tol=None, gtol=None, max_time=None, callback=None):
     """
     a straight forward python translation of Carl Edward Rasmussen's original
     U{minimize.m<http://www.gatsby.ucl.ac.uk/~edward/code/minimize/minimize.m>}
@@ -70,6 +78,12 @@ def minimize(f, X, length=100):
     @param X:
     @param length:
     @type length:
+    @param tol: relative improvement of the function value below which a successful line search ends the run,
+                None to disable
+    @param gtol: gradient norm below which a successful line search ends the run, None to disable
+    @param max_time: wall-clock budget in seconds, checked before each line search, None to disable
+    @param callback: called after each successful line search as callback(i, f1, |df1|, n_evals),
+                     the run ends if it returns True
     @return:
     """
 # # RHO = 0.01;                                    % a bunch of constants for line searches
@@ -111,6 +125,8 @@ def minimize(f, X, length=100):
     ls_failed = 0
 # # fX = [];
     fX = []
+    f = CountedFunction(f)
+    deadline = None if max_time is None else time.perf_counter() + max_time
 # # [f1 df1] = eval(argstr);                              % get function value and gradient
     f1, df1 = f(X)
 # # i = i + (length<0);                                                    % count epochs?!
@@ -124,6 +140,8 @@ def minimize(f, X, length=100):
 # #
 # # while i < abs(length)                                              % while not finished
     while i < abs(length):
+        if (deadline is not None) and (time.perf_counter() >= deadline):            # out of time
+            break
 # #     i = i + (length>0);                                            % count iterations?!
         i += (length > 0)
 # #
@@ -268,6 +286,8 @@ def minimize(f, X, length=100):
             fX.append(f1)
 # #         fprintf('%s %6i;  Value %4.6e\r', S, i, f1);
             print('{} {:>6}:  Value {:4.6e}'.format(S, i, f1))
+            if stop_early(i, f0, f1, df2, f.n_evals, tol, gtol, callback):     # converged, no need to go on
+                break
 # #         s = (df2'*df2-df1'*df2)/(df1'*df1)*s - df2;          % Polack-Ribiere direction
             s = (df2.dot(df2)-df1.dot(df2))/(df1.dot(df1))*s - df2
 # #         tmp = df1; df1 = df2; df2 = tmp;                             % swap derivatives
@@ -322,6 +342,223 @@ def minimize(f, X, length=100):
     return X, np.array(fX), i
 
 
+def minimize_in_place(f, X, length=100, tol=None, gtol=None, max_time=None, callback=None):
+    """
+    the same algorithm as minimize, step for step, so it visits exactly the same points, but
+
+    - X, X0, s, the gradients and one temporary are allocated once and updated in place,
+      f must take a second argument out and write the gradient into it,
+      e.g. collaborative_filtering.CostFunction
+    - the line search works on python floats instead of numpy scalars
+    - progress goes to the logger of this module instead of stdout
+
+    @param f: f(X, out) returns the function value and out filled with the gradient
+    @param X: starting point, it is not modified. the work vectors take its dtype if it is a floating point array,
+              float64 otherwise
+    @param length: see minimize
+    @param tol: see minimize
+    @param gtol: see minimize
+    @param max_time: see minimize
+    @param callback: see minimize
+    @return: X, fX, i, like minimize
+    """
+    RHO = 0.01
+    SIG = 0.5
+    INT = 0.1
+    EXT = 3.0
+    MAX = 20
+    RATIO = 100
+
+    red = 1
+    if (type(length) != int) and (len(length) == 2):
+        red = length[1]
+        length = length[0]
+
+    if length > 0:
+        S = 'Linesearch'
+    else:
+        S = 'Function evaluation'
+
+    # work vectors, references to them are swapped where minimize rebinds names
+    X = np.asarray(X)
+    X = np.array(X, dtype=X.dtype if X.dtype.kind == "f" else np.float64)
+    X0 = np.empty_like(X)
+    s = np.empty_like(X)
+    tmp = np.empty_like(X)
+    df1 = np.empty_like(X)
+    df2 = np.empty_like(X)
+    eps = float(np.finfo(df1.dtype).eps)
+    nan = float("nan")
+
+    f = CountedFunction(f)
+    deadline = None if max_time is None else time.perf_counter() + max_time
+
+    i = 0
+    ls_failed = 0
+    fX = []
+    f1 = float(f(X, df1)[0])
+    i += (length < 0)
+    np.negative(df1, out=s)
+    d1 = -float(s.dot(s))
+    z1 = red/(1-d1)
+
+    while i < abs(length):
+        if (deadline is not None) and (time.perf_counter() >= deadline):
+            break
+        i += (length > 0)
+
+        # df0 is df1, which is not written during the line search
+        np.copyto(X0, X)
+        f0 = f1
+        df0 = df1
+        np.multiply(s, z1, out=tmp)
+        X += tmp
+        f2 = float(f(X, df2)[0])
+        i += (length < 0)
+        d2 = float(df2.dot(s))
+        f3 = f1
+        d3 = d1
+        z3 = -z1
+        if length > 0:
+            M = MAX
+        else:
+            M = min(MAX, -length-i)
+        success = 0
+        limit = -1
+        while True:
+            while ((f2 > f1+z1*RHO*d1) or (d2 > -SIG*d1)) and (M > 0):
+                limit = z1
+                if f2 > f1:
+                    denominator = d3*z3+f2-f3
+                    z2 = z3 - (0.5*d3*z3*z3)/denominator if denominator != 0 else nan
+                else:
+                    A = 6*(f2-f3)/z3+3*(d2+d3)
+                    B = 3*(f3-f2)-z3*(d3+2*d2)
+                    q = B*B-A*d2*z3*z3
+                    z2 = (math.sqrt(q)-B)/A if (q >= 0) and (A != 0) else nan
+
+                if not math.isfinite(z2):
+                    z2 = z3/2
+
+                z2 = max(min(z2, INT*z3), (1-INT)*z3)
+                z1 = z1 + z2
+                np.multiply(s, z2, out=tmp)
+                X += tmp
+                f2 = float(f(X, df2)[0])
+                M -= 1
+                i += (length < 0)
+                d2 = float(df2.dot(s))
+                z3 = z3-z2
+
+            if (f2 > f1+z1*RHO*d1) or (d2 > -SIG*d1):
+                break
+            elif d2 > SIG*d1:
+                success = 1
+                break
+            elif M == 0:
+                break
+
+            A = 6*(f2-f3)/z3+3*(d2+d3)
+            B = 3*(f3-f2)-z3*(d3+2*d2)
+            q = B*B-A*d2*z3*z3
+            denominator = B+math.sqrt(q) if q >= 0 else 0.0        # complex root, same as ~isreal in minimize
+            z2 = -d2*z3*z3/denominator if denominator != 0 else nan
+            if (not math.isfinite(z2)) or (z2 < 0):
+                if limit < -0.5:
+                    z2 = z1 * (EXT-1)
+                else:
+                    z2 = (limit-z1)/2
+            elif (limit > -0.5) and (z2+z1 > limit):
+                z2 = (limit-z1)/2
+            elif (limit < -0.5) and (z2+z1 > z1*EXT):
+                z2 = z1*(EXT-1.0)
+            elif z2 < -z3*INT:
+                z2 = -z3*INT
+            elif (limit > -0.5) & (z2 < (limit-z1)*(1.0-INT)):
+                z2 = (limit-z1)*(1.0-INT)
+
+            f3 = f2
+            d3 = d2
+            z3 = -z2
+            z1 += z2
+            np.multiply(s, z2, out=tmp)
+            X += tmp
+            f2 = float(f(X, df2)[0])
+            M -= 1
+            i += (length < 0)
+            d2 = float(df2.dot(s))
+
+        if success:
+            f1 = f2
+            fX.append(f1)
+            logger.debug('{} {:>6}:  Value {:4.6e}'.format(S, i, f1))
+            if stop_early(i, f0, f1, df2, f.n_evals, tol, gtol, callback):
+                break
+            s *= (float(df2.dot(df2))-float(df1.dot(df2)))/float(df1.dot(df1))
+            s -= df2
+            df1, df2 = df2, df1
+            d2 = float(df1.dot(s))
+            if d2 > 0:
+                np.negative(df1, out=s)
+                d2 = -float(s.dot(s))
+
+            z1 = z1 * min(RATIO, d1/(d2-eps))
+            d1 = d2
+            ls_failed = 0
+        else:
+            X, X0 = X0, X
+            f1 = f0
+            df1 = df0
+            if ls_failed or (i > abs(length)):
+                break
+
+            df1, df2 = df2, df1
+            np.negative(df1, out=s)
+            d1 = -float(s.dot(s))
+            z1 = 1/(1-d1)
+            ls_failed = 1
+
+    return X, np.array(fX), i
+
+
+class CountedFunction(object):
+    """
+    wraps the function being minimized and counts its evaluations
+    """
+    def __init__(self, f):
+        self.f = f
+        self.n_evals = 0
+
+    def __call__(self, *args):
+        self.n_evals += 1
+        return self.f(*args)
+
+
+def stop_early(i, f0, f1, df1, n_evals, tol, gtol, callback):
+    """
+    the checks done after each successful line search, on top of the ones of the original minimize.m
+
+    @param i: run length counter
+    @param f0: function value before the line search
+    @param f1: function value after the line search
+    @param df1: gradient after the line search
+    @param n_evals: number of function evaluations so far
+    @param tol: see minimize
+    @param gtol: see minimize
+    @param callback: see minimize
+    @return: True if the run should end
+    """
+    df1_norm = math.sqrt(float(df1.dot(df1)))
+    if (callback is not None) and callback(i, f1, df1_norm, n_evals):
+        return True
+    if (tol is not None) and (f0 - f1 <= tol*abs(f0)):
+        return True
+    if (gtol is not None) and (df1_norm <= gtol):
+        return True
+
+    return False
+
+
 def main():
     pass
 
@@ -1,11 +1,22 @@
 __author__ = 'Antares'
 
+import os
+import csv
+import copy
+import queue
+import hashlib
 import logging
+import tempfile
 import datetime
-import mysql.connector
+import threading
 import numpy as np
-import pandas as pd
-from collaborative_filtering import learn
+import concurrent.futures
+from collaborative_filtering import learn, predict_top_k, iter_top_k, warm_start_factors, rating_biases
+from instrumentation import Instrumentation
+from training_cache import TrainingCache
+from factor_store import write_factor_store
+from ann_index import build_ivf_index
+# pandas and mysql.connector are imported by the methods that read or write the database, they are slow to import
 
 
 class NiureadRecommender(object):
@@ -13,6 +24,7 @@ class NiureadRecommender(object):
 
     """
     CONFIG_FILE_PATH = "connection.conf"
+    MODEL_FILE_PATH = "model.npz"
     DB_NAME = "onebook"
     TABLE_BOOK_INFO = "t_book_info"
     ATTR_BOOK_INFO_ID = "bookInfoId"
@@ -22,100 +34,650 @@ class NiureadRecommender(object):
     ATTR_RATING_SCORE = "score"
     TABLE_RECOMMENDATION_HISTORY = "t_userRecommendedBook"
     ATTR_RECOMMENDED_SCORE = "calculatedScore"
+    ATTR_RECOMMENDED_DATE = "RecommendedDate"
 
     NUM_FEATURES = 10
     REGULATION_LAMBDA = 0.5
     NUM_ITERATION = 100
+    BIAS_SHRINKAGE = 0.0  # weight of the douban prior of a book in number of ratings, 0 for the mean of its ratings
+    USER_BIAS_SHRINKAGE = None  # shrinkage of the per-user biases, None for no user biases
+    ENGINE = "cg"
+    N_JOBS = 1
+    LEARNING_RATE = None  # for the stochastic engines, None for the default of the engine
+    BATCH_SIZE = 1024
+    DTYPE = np.float64  # np.float32 halves the memory and bandwidth of training and scoring
+    NUM_RECOMMENDATIONS = 1
+    SCORING_BLOCK_SIZE = 1024
+    WARM_START = True
+    WARM_START_TOLERANCE = 1e-4
+    TOLERANCE = None  # relative cost improvement below which a cold run stops
+    GRADIENT_TOLERANCE = None
+    MAX_TRAINING_SECONDS = None
+    PUSH_BATCH_SIZE = 1000
+    INGEST_CHUNK_SIZE = 10000
+    RECOMMENDATION_LOOK_BACK_DAYS = None
+    POOL_SIZE = 5  # 0 to open a new connection every time
+    BOOK_SEGMENT_COLUMNS = ()  # more columns of the books read by get_books, for the book_filter of Segment
+    USER_SEGMENT_COLUMNS = ()  # more columns of the users read by get_users, for the user_filter of Segment
+    SEGMENT_JOBS = 1  # number of processes training segments at the same time, 1 to train them one by one
+    PUSH_WITH_LOAD_DATA = False
+    # read the four tables at the same time and push each block of users from a writer thread as soon as it is
+    # scored. the reads take PIPELINE_CONNECTIONS connections at once, so POOL_SIZE must be 0 or at least that
+    PIPELINED = False
+    PIPELINE_CONNECTIONS = 5
+    PIPELINE_QUEUE_SIZE = 8  # blocks of recommendations scored but not written yet, before scoring waits
+    INSTRUMENTATION = True  # False turns off the stage timings and counters
+    TRACE_MEMORY = False  # record the tracemalloc peak of each stage, slows down the ingest
+    TRAINING_CACHE_DIRECTORY = "training_cache"  # None to read all the tables from the database every run
+    # auto-increment columns of the history tables. with one, the cache fetches only the rows added since the
+    # last run. without one, a table is read again whenever it changed or its UPDATE_TIME is unknown
+    ATTR_RATING_KEY = None
+    ATTR_RECOMMENDATION_KEY = None
+    # number of lists of the approximate index probed per user, None to score every book.
+    # more probes give a higher recall and a slower scoring, the recall is counted as ann_recall
+    ANN_N_PROBE = None
+    ANN_N_LISTS = None  # None for sqrt(number of books)
+    ANN_RECALL_SAMPLE = 1000  # number of users the recall is measured on
+    FACTOR_STORE_DIRECTORY = "factor_store"  # where factor_store.FactorStore finds the factors, None to not write it
 
     # DOUBAN_WEIGHT = 5
 
-    def __init__(self):
+    def __init__(self, sink=None):
         """
 
+        @param sink: where the stage timings and counters go, see instrumentation.LoggingSink
         """
-        pass
-        # TODO setup logger
+        self.pool = None
+        self.convergence = []  # (i, cost, |gradient|, n_evals) of each iteration of the last training
+        self.instrumentation = Instrumentation(sink=sink, enabled=self.INSTRUMENTATION,
+                                               trace_memory=self.TRACE_MEMORY)
 
     def recommend(self):
         """
+        read the tables, train, score and push the recommendations of every user.
+        with PIPELINED the push overlaps with the scoring, each block of users is committed once it is written
+        """
+        if self.PIPELINED and (0 < self.POOL_SIZE < self.PIPELINE_CONNECTIONS):
+            raise ValueError("a pipelined run needs a POOL_SIZE of 0 or at least {}, not {}".format(
+                self.PIPELINE_CONNECTIONS, self.POOL_SIZE))
+
+        self.instrumentation.reset()
+        book_ids, douban, user_ids, indexed_rating, indexed_recommendation = self.ingest()
+        if self.PIPELINED:
+            writer = BackgroundWriter(self, self.PIPELINE_QUEUE_SIZE)
+            try:
+                self.train_and_score(book_ids, douban, user_ids, indexed_rating, indexed_recommendation,
+                                     on_block=writer.put)
+            finally:
+                # only the blocks still queued when the scoring ends are waited for
+                with self.instrumentation.stage("push"):
+                    writer.close()
+            return
+
+        recommendations = self.train_and_score(book_ids, douban, user_ids, indexed_rating, indexed_recommendation)
+
+        # push recommendations to database
+        with self.instrumentation.stage("push"):
+            self.push_recommendations(recommendations)
+
+    def recommend_segments(self, segments):
+        """
+        train one model per segment and push the recommendations of all of them in one transaction.
+        the tables of each database are read once and split by segment, the segments are trained
+        in SEGMENT_JOBS processes. the stages and counters of a segment are prefixed by its name,
+        the rows read are counted over all the databases
+
+        @param segments: a list of Segment, segments with a DB_NAME setting read the tables of that database
+        """
+        names = [segment.name for segment in segments]
+        if len(set(names)) < len(names):
+            raise ValueError("segment names must be unique, their models and factor stores are named after them: "
+                             "{}".format(", ".join(sorted(set(name for name in names if names.count(name) > 1)))))
+
+        self.instrumentation.reset()
+
+        tenants = {}
+        for segment in segments:
+            tenants.setdefault(segment.settings.get("DB_NAME", self.DB_NAME), []).append(segment)
+
+        jobs = []
+        with self.instrumentation.stage("ingest"), self.connect() as cnx:
+            for db_name, tenant_segments in tenants.items():
+                tenant = self.with_settings(DB_NAME=db_name)
+                books = tenant.get_books(cnx)
+                users = tenant.get_users(cnx)
+                book_ids = np.array(books[self.ATTR_BOOK_INFO_ID])
+                user_ids = np.array(users[self.ATTR_USER_INFO_ID])
+                douban = np.array(books["doubanScore"], dtype=np.float64)
+                book_lookup = id_lookup(book_ids)
+                user_lookup = id_lookup(user_ids)
+                indexed_rating = tenant.get_rating_history(cnx, book_lookup, user_lookup)
+                indexed_recommendation = tenant.get_recommendation_history(cnx, book_lookup, user_lookup)
+                # the rows read from all the databases
+                for name, value in tenant.instrumentation.counters.items():
+                    self.instrumentation.counters[name] = self.instrumentation.counters.get(name, 0) + value
+
+                for segment in tenant_segments:
+                    book_index, user_index = segment.select(books, users)
+                    book_lookup = id_lookup(book_index)
+                    user_lookup = id_lookup(user_index)
+                    jobs.append((self.for_segment(segment),
+                                 book_ids[book_index], douban[book_index], user_ids[user_index],
+                                 index_rows(indexed_rating, book_lookup, user_lookup),
+                                 index_rows(indexed_recommendation, book_lookup, user_lookup)))
+
+        # the stages of the segments are measured on their own, a stage around them in this process
+        # would be nested and its memory peak reset by them
+        if self.SEGMENT_JOBS <= 1:
+            results = [train_segment(*job) for job in jobs]
+        else:
+            with self.instrumentation.stage("train"):
+                with concurrent.futures.ProcessPoolExecutor(self.SEGMENT_JOBS) as executor:
+                    results = list(executor.map(train_segment, *zip(*jobs)))
+
+        for recommendations, stages, counters in results:
+            self.instrumentation.stages.update(stages)
+            self.instrumentation.counters.update(counters)
+
+        # one connection for the transaction, it allows LOAD DATA LOCAL INFILE if any segment pushes with it
+        pusher = self.with_settings(PUSH_WITH_LOAD_DATA=any(segment.PUSH_WITH_LOAD_DATA for segment, *arrays in jobs))
+        with self.instrumentation.stage("push"), pusher.connect() as cnx:
+            try:
+                for (segment, *arrays), (recommendations, stages, counters) in zip(jobs, results):
+                    if segment.PUSH_WITH_LOAD_DATA:
+                        segment.load_recommendations(cnx, recommendations, commit=False)
+                    else:
+                        segment.write_recommendations(cnx, recommendations, segment.PUSH_BATCH_SIZE, commit=False)
+                cnx.commit()
+            except Exception:
+                cnx.rollback()
+                raise
+
+    def with_settings(self, **settings):
+        """
+        a copy of this recommender with some of the class attributes overridden. it shares the connection pool,
+        unless a setting of CONNECTION_SETTINGS changes
+
+        @param settings: like NUM_FEATURES=20
+        @return:
+        """
+        recommender = copy.copy(self)
+        # copy drops the pool, see __getstate__
+        recommender.pool = self.pool
+        for name, value in settings.items():
+            if not hasattr(type(self), name):
+                raise AttributeError("unknown setting {}".format(name))
+            if (name in CONNECTION_SETTINGS) and (value != getattr(self, name)):
+                recommender.pool = None
+            setattr(recommender, name, value)
+        recommender.convergence = []
+        recommender.instrumentation = copy.copy(self.instrumentation)
+        recommender.instrumentation.reset()
+
+        return recommender
+
+    def for_segment(self, segment):
+        """
+        the recommender that trains a segment, its model and factor store are named after the segment
+
+        @param segment:
+        @return:
+        """
+        root, extension = os.path.splitext(self.MODEL_FILE_PATH)
+        settings = dict(MODEL_FILE_PATH="{}_{}{}".format(root, segment.name, extension))
+        if self.FACTOR_STORE_DIRECTORY is not None:
+            settings["FACTOR_STORE_DIRECTORY"] = "{}_{}".format(self.FACTOR_STORE_DIRECTORY, segment.name)
+        settings.update(segment.settings)
+        recommender = self.with_settings(**settings)
+        recommender.instrumentation.prefix = "{}{}.".format(self.instrumentation.prefix, segment.name)
+
+        return recommender
+
+    def __getstate__(self):
+        # the connection pool can not be pickled, a recommender in another process connects on its own
+        state = self.__dict__.copy()
+        state["pool"] = None
+
+        return state
+
+    def ingest(self):
+        """
+        get data from database, the history tables are mapped to (book_index, user_index).
+        with PIPELINED the tables are read at the same time, each on a connection of its own
+
+        @return: book_ids, douban, user_ids, indexed_rating, indexed_recommendation, see read_tables
+        """
+        with self.instrumentation.stage("ingest"):
+            if (self.TRAINING_CACHE_DIRECTORY is None) and self.PIPELINED:
+                return self.read_tables_concurrently()
+
+            with self.connect() as cnx:
+                if self.TRAINING_CACHE_DIRECTORY is None:
+                    return self.read_tables(cnx)
+
+                return self.read_cached_tables(cnx, TrainingCache(self.TRAINING_CACHE_DIRECTORY),
+                                               parallel=self.PIPELINED)
+
+    def train_and_score(self, book_ids, douban, user_ids, indexed_rating, indexed_recommendation, on_block=None):
+        """
+        train on the ratings, save the model and the factor store, and find the recommendations
+
+        @param book_ids: see read_tables
+        @param douban:
+        @param user_ids:
+        @param indexed_rating:
+        @param indexed_recommendation:
+        @param on_block: called with the recommendations of each block of users as soon as it is scored,
+                         None to score all the users at once
+        @return: the recommendations, see assemble_recommendations
+        """
+        instrumentation = self.instrumentation
+        num_books = book_ids.size
+        num_users = user_ids.size
+        instrumentation.count("books", num_books)
+        instrumentation.count("users", num_users)
+        instrumentation.count("ratings", indexed_rating.shape[0])
+        instrumentation.count("recommendation_history", indexed_recommendation.shape[0])
+
+        # warm-start from the factors of the previous run
+        initial = None
+        tol = self.TOLERANCE
+        with instrumentation.stage("warm_start"):
+            model = self.load_model() if self.WARM_START else None
+            if (model is not None) and (model["x"].shape[1] == self.NUM_FEATURES):
+                initial = (warm_start_factors(model["user_ids"], model["theta"], user_ids),
+                           warm_start_factors(model["book_ids"], model["x"], book_ids))
+                tol = self.WARM_START_TOLERANCE
+
+        # item biases from the ratings shrunk towards the douban prior, and the optional user biases.
+        # they are subtracted from the ratings for training and added back by broadcasting at scoring time
+        with instrumentation.stage("biases"):
+            item_bias, user_bias = rating_biases(indexed_rating, num_books, num_users,
+                                                 prior=douban_prior(douban),
+                                                 shrinkage=self.BIAS_SHRINKAGE,
+                                                 user_shrinkage=self.USER_BIAS_SHRINKAGE)
+
+        self.convergence = []
+        # start training, the (book_index, user_index, score) triples are used directly as sparse ratings
+        with instrumentation.stage("optimise"):
+            theta, x, y_mean, cost, reg_cost = learn(shape_theta=(num_users, self.NUM_FEATURES),
+                                                     shape_x=(num_books, self.NUM_FEATURES),
+                                                     y=indexed_rating,
+                                                     r=None,
+                                                     reg_lambda=self.REGULATION_LAMBDA,
+                                                     n_iter=self.NUM_ITERATION,
+                                                     engine=self.ENGINE,
+                                                     n_jobs=self.N_JOBS,
+                                                     initial=initial,
+                                                     tol=tol,
+                                                     gtol=self.GRADIENT_TOLERANCE,
+                                                     max_time=self.MAX_TRAINING_SECONDS,
+                                                     callback=self.record_convergence,
+                                                     learning_rate=self.LEARNING_RATE,
+                                                     batch_size=self.BATCH_SIZE,
+                                                     dtype=self.DTYPE,
+                                                     biases=(item_bias, user_bias))
+        instrumentation.count("iterations", len(self.convergence))
+        instrumentation.count("function_evaluations", self.convergence[-1][3] if self.convergence else 0)
+        with instrumentation.stage("save_model"):
+            self.save_model(theta, x, y_mean, book_ids, user_ids)
+        if len(cost) > 0:
+            logging.debug("regulation cost is {:0.3}% of total cost".format((reg_cost/cost[-1])*100))
+
+        with instrumentation.stage("score"):
+            # y_mean is the item bias, books without ratings have their douban prior
+            mean = y_mean
+            tmr = (datetime.datetime.today() + datetime.timedelta(1)).strftime("%Y-%m-%d")
+
+            # generate recommendation, rated and already recommended books are excluded
+            excluded = [indexed_recommendation, indexed_rating]
+            index = None
+            if self.ANN_N_PROBE is not None:
+                index = build_ivf_index(x, mean, n_lists=self.ANN_N_LISTS)
+            if on_block is not None:
+                prediction, recommendations = self.score_blocks(theta, x, mean, user_bias, excluded, index,
+                                                                book_ids, user_ids, tmr, on_block)
+            elif index is None:
+                prediction, score = predict_top_k(theta, x, mean,
+                                                  excluded=excluded,
+                                                  k=self.NUM_RECOMMENDATIONS,
+                                                  block_size=self.SCORING_BLOCK_SIZE,
+                                                  dtype=self.DTYPE,
+                                                  user_bias=user_bias)
+                recommendations = assemble_recommendations(user_ids, book_ids, prediction, score, tmr)
+            else:
+                prediction, score = index.search(theta, self.NUM_RECOMMENDATIONS, self.ANN_N_PROBE,
+                                                 excluded=excluded,
+                                                 block_size=self.SCORING_BLOCK_SIZE,
+                                                 user_bias=user_bias)
+                recommendations = assemble_recommendations(user_ids, book_ids, prediction, score, tmr)
+        instrumentation.count("recommendations", recommendations.size)
+        if (index is not None) and instrumentation.enabled:
+            instrumentation.count("ann_recall", index.recall(theta, self.NUM_RECOMMENDATIONS, self.ANN_N_PROBE,
+                                                             sample_size=self.ANN_RECALL_SAMPLE))
+
+        # publish the factors for on-demand scoring, with the books recommended today excluded too
+        if self.FACTOR_STORE_DIRECTORY is not None:
+            with instrumentation.stage("factor_store"):
+                recommended = np.column_stack((prediction.ravel(),
+                                               np.repeat(np.arange(num_users), prediction.shape[1])))
+                write_factor_store(self.FACTOR_STORE_DIRECTORY, theta, x, mean, book_ids, user_ids,
+                                   id_lookup(book_ids), id_lookup(user_ids),
+                                   excluded=[indexed_recommendation, indexed_rating, recommended], index=index,
+                                   user_bias=user_bias)
+
+        return recommendations
+
+    def score_blocks(self, theta, x, mean, user_bias, excluded, index, book_ids, user_ids, date, on_block):
+        """
+        score the users one block at a time, and hand the recommendations of each block to on_block
+        before the next one is scored
+
+        @param theta:
+        @param x:
+        @param mean:
+        @param user_bias:
+        @param excluded: see predict_top_k
+        @param index: an ann_index.IVFIndex, None to score every book
+        @param book_ids:
+        @param user_ids:
+        @param date: RecommendedDate of the recommendations
+        @param on_block: see train_and_score
+        @return: the book indexes of all the users, and all the recommendations
+        """
+        if index is None:
+            blocks = iter_top_k(theta, x, mean, excluded=excluded, k=self.NUM_RECOMMENDATIONS,
+                                block_size=self.SCORING_BLOCK_SIZE, dtype=self.DTYPE, user_bias=user_bias)
+        else:
+            blocks = index.iter_search(theta, self.NUM_RECOMMENDATIONS, self.ANN_N_PROBE, excluded=excluded,
+                                       block_size=self.SCORING_BLOCK_SIZE, user_bias=user_bias)
+
+        predictions = []
+        recommendations = []
+        for lo, prediction, score in blocks:
+            predictions.append(prediction)
+            recommendations.append(assemble_recommendations(user_ids[lo:lo+prediction.shape[0]], book_ids,
+                                                            prediction, score, date))
+            on_block(recommendations[-1])
+        if not predictions:
+            return np.empty((0, self.NUM_RECOMMENDATIONS), dtype=np.intp), np.zeros(0, dtype=RECOMMENDATION_DTYPE)
+
+        return np.concatenate(predictions), np.concatenate(recommendations)
+
+    def record_convergence(self, i, cost, gradient_norm, n_evals):
+        """
+        callback of learn, keeps the convergence curve of the current training in self.convergence
+
+        @return: False, never stops the training
+        """
+        self.convergence.append((i, cost, gradient_norm, n_evals))
+
+        return False
+
+    def connect(self):
+        """
+        get a connection to the database. when POOL_SIZE > 0 the connections come from a pool created on first use,
+        so the reads, writes and test queries of this recommender reuse them instead of reconnecting every time.
+        the pool is created once even when the first connections are made from several threads
+
+        @return: a MyConnection
+        """
+        if self.POOL_SIZE <= 0:
+            return MyConnection(option_files=self.CONFIG_FILE_PATH, allow_local_infile=self.PUSH_WITH_LOAD_DATA)
 
+        with POOL_LOCK:
+            if self.pool is None:
+                import mysql.connector.pooling
+                self.pool = mysql.connector.pooling.MySQLConnectionPool(pool_name="niuread_{}".format(id(self)),
+                                                                        pool_size=self.POOL_SIZE,
+                                                                        option_files=self.CONFIG_FILE_PATH,
+                                                                        allow_local_infile=self.PUSH_WITH_LOAD_DATA)
+        return MyConnection(pool=self.pool)
+
+    def save_model(self, theta, x, y_mean, book_ids, user_ids):
+        """
+        save the learned factors and the id of each row, so the next run can warm-start from them
+
+        @param theta:
+        @param x:
+        @param y_mean:
+        @param book_ids: bookInfoId of each row of x and y_mean
+        @param user_ids: userInfoId of each row of theta
+        """
+        temp_path = self.MODEL_FILE_PATH + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, theta=theta, x=x, y_mean=y_mean, book_ids=book_ids, user_ids=user_ids)
+        os.replace(temp_path, self.MODEL_FILE_PATH)
+
+    def load_model(self):
+        """
+        load the factors saved by save_model
+
+        @return: a dict of theta, x, y_mean, book_ids and user_ids, or None if nothing has been saved
+        """
+        if not os.path.exists(self.MODEL_FILE_PATH):
+            return None
+        with np.load(self.MODEL_FILE_PATH) as model:
+            return dict(model)
+
+    def read_tables(self, cnx):
+        """
+        read the books and users, and stream the history tables mapped to indexes
+
+        @param cnx:
+        @return: book_ids, douban, user_ids, indexed_rating, indexed_recommendation
+        """
+        books = self.get_books(cnx)
+        users = self.get_users(cnx)
+        book_ids = np.array(books[self.ATTR_BOOK_INFO_ID])
+        user_ids = np.array(users[self.ATTR_USER_INFO_ID])
+        book_lookup = id_lookup(book_ids)
+        user_lookup = id_lookup(user_ids)
+        indexed_rating = self.get_rating_history(cnx, book_lookup, user_lookup)
+        indexed_recommendation = self.get_recommendation_history(cnx, book_lookup, user_lookup)
+
+        return (book_ids, np.array(books["doubanScore"], dtype=np.float64), user_ids,
+                indexed_rating, indexed_recommendation)
+
+    def read_tables_concurrently(self):
+        """
+        like read_tables, but the four tables are read at the same time, each on a connection of its own.
+        the history rows can only be mapped to indexes once the books and users are read, so they are
+        held as they are read until then
+
+        @return: see read_tables
+        """
+        books, users, rating, recommendation = self.call_on_connections(None, [(self.get_books,),
+                                                                               (self.get_users,),
+                                                                               (self.read_rating_history,),
+                                                                               (self.read_recommendation_history,)],
+                                                                        parallel=True)
+        book_ids = np.array(books[self.ATTR_BOOK_INFO_ID])
+        user_ids = np.array(users[self.ATTR_USER_INFO_ID])
+        book_lookup = id_lookup(book_ids)
+        user_lookup = id_lookup(user_ids)
+
+        return (book_ids, np.array(books["doubanScore"], dtype=np.float64), user_ids,
+                index_rows(rating, book_lookup, user_lookup), index_rows(recommendation, book_lookup, user_lookup))
+
+    def call_on_connections(self, cnx, calls, parallel=False):
+        """
+        make calls of methods whose first argument is a connection
+
+        @param cnx: the connection of all the calls when they are not parallel
+        @param calls: a list of (method, *args)
+        @param parallel: True to make the calls at the same time from threads, each with a connection of its own
+                         from connect, so the pool needs a free connection for each call
+        @return: a list of the results of the calls
+        """
+        if not parallel:
+            return [method(cnx, *args) for method, *args in calls]
+
+        with concurrent.futures.ThreadPoolExecutor(len(calls)) as executor:
+            futures = [executor.submit(self.call_with_connection, method, *args) for method, *args in calls]
+            return [future.result() for future in futures]
+
+    def call_with_connection(self, method, *args):
+        with self.connect() as cnx:
+            return method(cnx, *args)
+
+    def read_cached_tables(self, cnx, cache, parallel=False):
+        """
+        like read_tables, but only the tables that changed since they were cached are read, and the indexed
+        history is only recomputed for new rows, or for all rows when the books or users changed.
+        a table is taken as unchanged when its row count, max key and UPDATE_TIME are the same.
+        the history tables are taken as append-only when they have a key column
+
+        @param cnx:
+        @param cache: a TrainingCache
+        @param parallel: True to read the tables at the same time, see call_on_connections
+        @return: see read_tables, the arrays are memory mapped from the cache
+        """
+        keys = self.table_keys(cnx)
+
+        rating_columns = [self.ATTR_BOOK_INFO_ID, self.ATTR_USER_INFO_ID, self.ATTR_RATING_SCORE]
+        calls = [(self.update_cached_books, cache, keys["books"]),
+                 (self.update_cached_users, cache, keys["users"]),
+                 (self.update_cached_history, cache, "rating", self.TABLE_RATING_HISTORY, rating_columns,
+                  self.ATTR_RATING_KEY, keys["rating"])]
+        if self.RECOMMENDATION_LOOK_BACK_DAYS is None:
+            recommendation_columns = [self.ATTR_BOOK_INFO_ID, self.ATTR_USER_INFO_ID]
+            calls.append((self.update_cached_history, cache, "recommendation", self.TABLE_RECOMMENDATION_HISTORY,
+                          recommendation_columns, self.ATTR_RECOMMENDATION_KEY, keys["recommendation"]))
+        else:
+            # the look-back window moves every day, so it is not cached
+            calls.append((self.read_recommendation_history,))
+        recommendation = self.call_on_connections(cnx, calls, parallel)[-1]
+
+        book_ids = cache.load("book_ids")
+        user_ids = cache.load("user_ids")
+        book_lookup = id_lookup(book_ids)
+        user_lookup = id_lookup(user_ids)
+        ids_key = [hashlib.sha1(book_ids.tobytes()).hexdigest(), hashlib.sha1(user_ids.tobytes()).hexdigest()]
+
+        indexed_rating = self.index_cached_history(cache, "rating", book_lookup, user_lookup, ids_key)
+        if self.RECOMMENDATION_LOOK_BACK_DAYS is None:
+            indexed_recommendation = self.index_cached_history(cache, "recommendation", book_lookup, user_lookup,
+                                                               ids_key)
+        else:
+            indexed_recommendation = index_rows(recommendation, book_lookup, user_lookup)
+
+        return book_ids, cache.load("douban"), user_ids, indexed_rating, indexed_recommendation
+
+    def update_cached_books(self, cnx, cache, key):
+        """
+        read the books if they changed since they were cached
+
+        @param cnx:
+        @param cache:
+        @param key: the key of the books table, see table_keys
         """
-        # get data from database
-        with MyConnection(option_files=self.CONFIG_FILE_PATH) as cnx:
+        if (cache.key("book_ids") != key) or (key[2] is None):
             books = self.get_books(cnx)
+            cache.replace("douban", np.array(books["doubanScore"], dtype=np.float64), key)
+            cache.replace("book_ids", np.array(books[self.ATTR_BOOK_INFO_ID], dtype=np.int64), key)
+
+    def update_cached_users(self, cnx, cache, key):
+        """
+        read the users if they changed since they were cached
+
+        @param cnx:
+        @param cache:
+        @param key: the key of the users table, see table_keys
+        """
+        if (cache.key("user_ids") != key) or (key[2] is None):
             users = self.get_users(cnx)
-            rating_history = self.get_rating_history(cnx)
-            recommendation_history = self.get_recommendation_history(cnx)
-
-        attr = ["book_index", "user_index", self.ATTR_RATING_SCORE]
-        merged_rating = rating_history.merge(books).merge(users)[attr]
-        indexed_rating = np.array(merged_rating)
-
-        attr = ["book_index", "user_index"]
-        merged_recommendation = recommendation_history.merge(books).merge(users)[attr]
-        indexed_recommendation = np.array(merged_recommendation)
-
-        print("books: \n", books, "\n")
-        print("users: \n", users, "\n")
-        print("rating history: \n", rating_history, "\n")
-        print("recommendation history: \n", recommendation_history, "\n")
-        print("merged rating: \n", merged_rating, "\n")
-        print("indexed rating: \n", indexed_rating, "\n")
-        print("merged recommendation: \n", merged_recommendation, "\n")
-        print("indexed recommendation: \n", indexed_recommendation, "\n")
-
-        num_books = books.shape[0]
-        num_users = users.shape[0]
-
-        # prepare arrays
-        y = np.zeros(shape=(num_books, num_users), dtype="int32")
-        r = np.zeros(shape=(num_books, num_users), dtype="int32")
-        y[indexed_rating[:, 0], indexed_rating[:, 1]] = indexed_rating[:, 2]
-        r[indexed_rating[:, 0], indexed_rating[:, 1]] = 1
-
-        # start training
-        theta, x, y_mean, cost, reg_cost = learn(shape_theta=(num_users, self.NUM_FEATURES),
-                                                 shape_x=(num_books, self.NUM_FEATURES),
-                                                 y=y,
-                                                 r=r,
-                                                 reg_lambda=self.REGULATION_LAMBDA,
-                                                 n_iter=self.NUM_ITERATION)
-        logging.debug("regulation cost is {:0.3}% of total cost".format((reg_cost/cost[-1])*100))
-
-        # TODO calculate y_mean according to user rating and douban rating
-        all_douban = np.array(books['doubanScore'])
-        valid_douban = (all_douban-1)/9*4 + 1  # scale
-        valid_douban[valid_douban<1] = 0
-        valid_douban[np.isnan(valid_douban)] = 0
-        valid_douban[valid_douban<=0] = 2.5
-        valid_douban = valid_douban.reshape((-1, 1))
-
-        mean = y_mean + valid_douban*(y_mean<=0)
-
-        # generate prediction
-        p = x.dot(theta.T) + mean.dot(np.ones((1, num_users)))
-
-        print(y_mean[633, 0])
-        print(valid_douban[633, 0])
-        # generate recommendation
-        p[indexed_recommendation[:, 0], indexed_recommendation[:, 1]] = 0
-        p[indexed_rating[:, 0], indexed_rating[:, 1]] = 0
-        prediction = np.argmax(p, axis=0)
-        score = np.max(p, axis=0)
+            cache.replace("user_ids", np.array(users[self.ATTR_USER_INFO_ID], dtype=np.int64), key)
 
-        recommendations = []
-        tmr = datetime.datetime.today() + datetime.timedelta(1)
-        for i in range(num_users):
-            entry = (0,
-                     users.iloc[i][self.ATTR_USER_INFO_ID],
-                     books.iloc[prediction[i]][self.ATTR_BOOK_INFO_ID],
-                     tmr.strftime("%Y-%m-%d"),
-                     score[i])
-            recommendations.append(entry)
-        print(recommendations)
+    def table_keys(self, cnx):
+        """
+        the row count, max key and UPDATE_TIME of each table, the caches of a table are valid as long as
+        its key does not change
 
-        # push recommendations to database
-        self.push_recommendations(recommendations)
+        @param cnx:
+        @return: a dict of [count, max key, update time or None] of "books", "users", "rating" and "recommendation"
+        """
+        tables = [("books", self.TABLE_BOOK_INFO, self.ATTR_BOOK_INFO_ID, " WHERE offline=0"),
+                  ("users", self.TABLE_USER_INFO, self.ATTR_USER_INFO_ID, ""),
+                  ("rating", self.TABLE_RATING_HISTORY, self.ATTR_RATING_KEY, ""),
+                  ("recommendation", self.TABLE_RECOMMENDATION_HISTORY, self.ATTR_RECOMMENDATION_KEY, "")]
+        with MyCursor(cnx, buffered=True) as cursor:
+            cursor.execute("SELECT TABLE_NAME, UPDATE_TIME FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s",
+                           (self.DB_NAME,))
+            update_times = {name: update_time for name, update_time in cursor.fetchall()}
+
+            keys = {}
+            for name, table, key_column, condition in tables:
+                cursor.execute("SELECT COUNT(*), {} FROM {}.{}{}".format(
+                    "MAX({})".format(key_column) if key_column is not None else "NULL",
+                    self.DB_NAME, table, condition))
+                count, max_key = cursor.fetchone()
+                update_time = update_times.get(table)
+                keys[name] = [int(count), None if max_key is None else int(max_key),
+                              None if update_time is None else str(update_time)]
+
+        return keys
+
+    def update_cached_history(self, cnx, cache, name, table, columns, key_column, key):
+        """
+        bring the cached rows of a history table up to date, with the ids as they are in the database
+
+        @param cnx:
+        @param cache:
+        @param name: name of the rows in the cache
+        @param table:
+        @param columns: the columns to read, bookInfoId and userInfoId first
+        @param key_column: an auto-increment column of the table, or None
+        @param key: the key of the table, see table_keys
+        """
+        cached = cache.key(name)
+        if (cached == key) and ((key_column is not None) or (key[2] is not None)):
+            return
+
+        query = "SELECT {} FROM {}.{}".format(", ".join(columns), self.DB_NAME, table)
+        if ((key_column is not None) and (cached is not None) and (cached[1] is not None) and (key[1] is not None)
+                and (key[1] > cached[1]) and (key[0] > cached[0])):
+            # rows were added, they are appended if they are all the rows added.
+            # otherwise rows were also changed or deleted, and the table is read again
+            rows = self.stream_rows(cnx, query + " WHERE {0} > %s AND {0} <= %s".format(key_column),
+                                    len(columns), params=(cached[1], key[1]), counter=name + "_rows_read")
+            if rows.shape[0] == key[0] - cached[0]:
+                cache.append(name, rows, key)
+                return
+
+        if key_column is not None:
+            rows = self.stream_rows(cnx, query + " WHERE {} <= %s".format(key_column), len(columns),
+                                    params=(key[1],), counter=name + "_rows_read")
+            cache.replace(name, rows, key)
+        else:
+            rows = self.stream_rows(cnx, query, len(columns), counter=name + "_rows_read")
+            cache.replace(name, rows, key)
+
+    def index_cached_history(self, cache, name, book_lookup, user_lookup, ids_key):
+        """
+        map the cached rows of a history table to indexes, only the new rows are mapped when the ids did not change
+
+        @param cache:
+        @param name: name of the rows in the cache
+        @param book_lookup:
+        @param user_lookup:
+        @param ids_key: changes whenever the ids of the books or users change
+        @return: the indexed rows, see stream_indexed
+        """
+        rows = cache.load(name)
+        indexed_name = "indexed_" + name
+        key = dict(ids=ids_key, version=cache.version(name), rows=rows.shape[0])
+        cached = cache.key(indexed_name)
+        if cached == key:
+            return cache.load(indexed_name)
+
+        if ((cached is not None) and (cached["ids"] == ids_key) and (cached["version"] == key["version"])
+                and (cached["rows"] <= key["rows"])):
+            cache.append(indexed_name, index_rows(rows[cached["rows"]:], book_lookup, user_lookup), key)
+        else:
+            cache.replace(indexed_name, index_rows(rows, book_lookup, user_lookup), key)
+
+        return cache.load(indexed_name)
 
     def get_books(self, cnx):
         """
@@ -123,11 +685,14 @@ class NiureadRecommender(object):
         @param cnx:
         @return:
         """
-        query = "SELECT {}, doubanScore FROM {}.{} WHERE offline=0".format(self.ATTR_BOOK_INFO_ID, self.DB_NAME, self.TABLE_BOOK_INFO)
+        query = "SELECT {}, doubanScore{} FROM {}.{} WHERE offline=0".format(
+            self.ATTR_BOOK_INFO_ID, "".join(", " + column for column in self.BOOK_SEGMENT_COLUMNS),
+            self.DB_NAME, self.TABLE_BOOK_INFO)
         # # TODO for test ONLY
         # query = "SELECT {} FROM {}.{} WHERE bookInfoId >= 450".format(self.ATTR_BOOK_INFO_ID,
         #                                                               self.DB_NAME,
         #                                                               self.TABLE_BOOK_INFO)
+        import pandas as pd
         books = pd.read_sql(query, con=cnx)
         books["book_index"] = books.index
 
@@ -139,46 +704,218 @@ class NiureadRecommender(object):
         @param cnx:
         @return:
         """
-        query = "SELECT {} FROM {}.{}".format(self.ATTR_USER_INFO_ID, self.DB_NAME, self.TABLE_USER_INFO)
+        query = "SELECT {}{} FROM {}.{}".format(
+            self.ATTR_USER_INFO_ID, "".join(", " + column for column in self.USER_SEGMENT_COLUMNS),
+            self.DB_NAME, self.TABLE_USER_INFO)
+        import pandas as pd
         users = pd.read_sql(query, con=cnx)
         users["user_index"] = users.index
 
         return users
 
-    def get_rating_history(self, cnx):
-        query = "SELECT {}, {}, {} FROM {}.{}".format(self.ATTR_USER_INFO_ID,
-                                                      self.ATTR_BOOK_INFO_ID,
-                                                      self.ATTR_RATING_SCORE,
-                                                      self.DB_NAME, self.TABLE_RATING_HISTORY)
-        rating_history = pd.read_sql(query, con=cnx)
+    def get_rating_history(self, cnx, book_lookup, user_lookup):
+        """
 
-        return rating_history
+        @param cnx:
+        @param book_lookup: see id_lookup
+        @param user_lookup: see id_lookup
+        @return: an array of shape (n, 3), each row is (book_index, user_index, score)
+        """
+        return self.stream_indexed(cnx, self.rating_history_query(), book_lookup, user_lookup, num_columns=3,
+                                   counter="rating_rows_read")
+
+    def read_rating_history(self, cnx):
+        """
+        like get_rating_history, but the rows are not mapped to indexes
+
+        @param cnx:
+        @return: an array of shape (n, 3), each row is (bookInfoId, userInfoId, score)
+        """
+        return self.stream_rows(cnx, self.rating_history_query(), num_columns=3, counter="rating_rows_read")
+
+    def rating_history_query(self):
+        return "SELECT {}, {}, {} FROM {}.{}".format(self.ATTR_BOOK_INFO_ID,
+                                                     self.ATTR_USER_INFO_ID,
+                                                     self.ATTR_RATING_SCORE,
+                                                     self.DB_NAME, self.TABLE_RATING_HISTORY)
+
+    def get_recommendation_history(self, cnx, book_lookup, user_lookup):
+        """
+        only the recommendations of the last RECOMMENDATION_LOOK_BACK_DAYS days are read, all of them if it is None
+
+        @param cnx:
+        @param book_lookup: see id_lookup
+        @param user_lookup: see id_lookup
+        @return: an array of shape (n, 2), each row is (book_index, user_index)
+        """
+        query, params = self.recommendation_history_query(cnx)
+
+        return self.stream_indexed(cnx, query, book_lookup, user_lookup, num_columns=2, params=params,
+                                   counter="recommendation_rows_read")
+
+    def read_recommendation_history(self, cnx):
+        """
+        like get_recommendation_history, but the rows are not mapped to indexes
+
+        @param cnx:
+        @return: an array of shape (n, 2), each row is (bookInfoId, userInfoId)
+        """
+        query, params = self.recommendation_history_query(cnx)
+
+        return self.stream_rows(cnx, query, num_columns=2, params=params, counter="recommendation_rows_read")
+
+    def recommendation_history_query(self, cnx):
+        """
+        the date is filtered on the server, with an index on (RecommendedDate, userInfoId) if there is one
+
+        @param cnx:
+        @return: the query and its parameters
+        """
+        query = "SELECT {}, {} FROM {}.{}".format(self.ATTR_BOOK_INFO_ID,
+                                                  self.ATTR_USER_INFO_ID,
+                                                  self.DB_NAME, self.TABLE_RECOMMENDATION_HISTORY)
+        params = None
+        if self.RECOMMENDATION_LOOK_BACK_DAYS is not None:
+            index = self.find_date_index(cnx)
+            if index is not None:
+                query += " USE INDEX (`{}`)".format(index)
+            query += " WHERE {} >= %s".format(self.ATTR_RECOMMENDED_DATE)
+            since = datetime.date.today() - datetime.timedelta(self.RECOMMENDATION_LOOK_BACK_DAYS)
+            params = (since.strftime("%Y-%m-%d"),)
+
+        return query, params
+
+    def find_date_index(self, cnx):
+        """
+        find an index of the recommendation history that starts with RecommendedDate,
+        one that continues with userInfoId is preferred
+
+        @param cnx:
+        @return: name of the index, or None
+        """
+        query = ("SELECT INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME FROM information_schema.STATISTICS "
+                 "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND SEQ_IN_INDEX <= 2")
+        with MyCursor(cnx, buffered=True) as cursor:
+            cursor.execute(query, (self.DB_NAME, self.TABLE_RECOMMENDATION_HISTORY))
+            columns = {(name, seq): column for name, seq, column in cursor.fetchall()}
+
+        candidates = [name for (name, seq), column in columns.items()
+                      if (seq == 1) and (column == self.ATTR_RECOMMENDED_DATE)]
+        candidates.sort(key=lambda name: columns.get((name, 2)) != self.ATTR_USER_INFO_ID)
 
-    def get_recommendation_history(self, cnx):
-        query = "SELECT {}, {}, {} FROM {}.{}".format(self.ATTR_USER_INFO_ID,
-                                                      self.ATTR_BOOK_INFO_ID,
-                                                      self.ATTR_RECOMMENDED_SCORE,
-                                                      self.DB_NAME, self.TABLE_RECOMMENDATION_HISTORY)
-        recommendation_history = pd.read_sql(query, con=cnx)
+        return candidates[0] if candidates else None
 
-        return recommendation_history
+    def stream_indexed(self, cnx, query, book_lookup, user_lookup, num_columns, params=None, counter=None):
+        """
+        stream the rows of query and map bookInfoId and userInfoId to indexes with index_rows,
+        rows of unknown books or users are dropped, like an inner join
+
+        @param cnx:
+        @param query: a query whose columns are bookInfoId, userInfoId and then any integer columns
+        @param book_lookup:
+        @param user_lookup:
+        @param num_columns:
+        @param params: parameters of query
+        @param counter: name of the instrumentation counter of the rows read, None to not count them
+        @return: an array of shape (n, num_columns), the first two columns are book_index and user_index
+        """
+        return self.stream_rows(cnx, query, num_columns, params=params, counter=counter,
+                                transform=lambda chunk: index_rows(chunk, book_lookup, user_lookup))
+
+    def stream_rows(self, cnx, query, num_columns, params=None, counter=None, transform=None):
+        """
+        fetch the rows of query INGEST_CHUNK_SIZE at a time from an unbuffered cursor,
+        and copy them into a preallocated array that grows by doubling
+
+        @param cnx:
+        @param query: a query whose columns are all integers
+        @param num_columns:
+        @param params: parameters of query
+        @param counter: name of the instrumentation counter of the rows read, None to not count them
+        @param transform: applied to each chunk of shape (n, num_columns) before it is copied, may drop rows
+        @return: an array of shape (n, num_columns)
+        """
+        indexed = np.empty((self.INGEST_CHUNK_SIZE, num_columns), dtype=np.int64)
+        size = 0
+        rows_read = 0
+        with MyCursor(cnx, buffered=False) as cursor:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(self.INGEST_CHUNK_SIZE)
+                if not rows:
+                    break
+
+                rows_read += len(rows)
+                chunk = np.array(rows, dtype=np.int64).reshape((-1, num_columns))
+                if transform is not None:
+                    chunk = transform(chunk)
+
+                if size + chunk.shape[0] > indexed.shape[0]:
+                    grown = np.empty((max(2*indexed.shape[0], size + chunk.shape[0]), num_columns), dtype=np.int64)
+                    grown[:size] = indexed[:size]
+                    indexed = grown
+                indexed[size: size+chunk.shape[0]] = chunk
+                size += chunk.shape[0]
+
+        if counter is not None:
+            self.instrumentation.count(counter, rows_read)
+
+        return indexed[:size]
 
     def push_recommendations(self, recommendations):
         """
         push the recommendations generated from collaborative filtering to database
 
-        @param recommendations: a list contains tuples of recommendation. a tuple should be like:
+        @param recommendations: a structured array made by assemble_recommendations, or a list contains tuples
+                                of recommendation. a tuple should be like:
                                 (0, userInfoId, bookInfoId, RecommendedDate, calculatedScore)
         """
-        with MyConnection(option_files=self.CONFIG_FILE_PATH) as cnx:
-            with MyCursor(cnx, buffered=True) as cursor:
-                print("start pushing recommendations to {} users".format(len(recommendations)))
-                for r in recommendations:
-                    query = "INSERT INTO {}.{} VALUES {}".format(self.DB_NAME, self.TABLE_RECOMMENDATION_HISTORY, r)
-                    print(query)
-                    cursor.execute(query)
+        with self.connect() as cnx:
+            logging.info("start pushing recommendations to {} users".format(len(recommendations)))
+            if self.PUSH_WITH_LOAD_DATA:
+                self.load_recommendations(cnx, recommendations)
+            else:
+                self.write_recommendations(cnx, recommendations, self.PUSH_BATCH_SIZE)
+            logging.info("finished")
+
+    def write_recommendations(self, cnx, recommendations, batch_size, commit=True):
+        """
+        insert the recommendations with a parameterised statement, batch_size rows per executemany,
+        each batch is committed on its own
+
+        @param cnx:
+        @param recommendations: see push_recommendations
+        @param batch_size:
+        @param commit: False to leave the commit to the caller
+        """
+        query = "INSERT INTO {}.{} VALUES (%s, %s, %s, %s, %s)".format(self.DB_NAME, self.TABLE_RECOMMENDATION_HISTORY)
+        with MyCursor(cnx) as cursor:
+            for start in range(0, len(recommendations), batch_size):
+                cursor.executemany(query, to_sql_rows(recommendations[start: start+batch_size]))
+                if commit:
+                    cnx.commit()
+
+    def load_recommendations(self, cnx, recommendations, commit=True):
+        """
+        write the recommendations to a temporary csv file and load it with LOAD DATA LOCAL INFILE,
+        the connection must be opened with allow_local_infile=True
+
+        @param cnx:
+        @param recommendations: see push_recommendations
+        @param commit: False to leave the commit to the caller
+        """
+        with tempfile.NamedTemporaryFile("w", newline="", suffix=".csv", delete=False) as f:
+            csv.writer(f).writerows(to_sql_rows(recommendations))
+        try:
+            query = ("LOAD DATA LOCAL INFILE %s INTO TABLE {}.{} "
+                     "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+                     "LINES TERMINATED BY '\\r\\n'").format(self.DB_NAME, self.TABLE_RECOMMENDATION_HISTORY)
+            with MyCursor(cnx) as cursor:
+                cursor.execute(query, (f.name,))
+            if commit:
                 cnx.commit()
-                print("finished")
+        finally:
+            os.remove(f.name)
 
     # def fake_ratings(self):
         # with MyConnection(option_files=self.CONFIG_FILE_PATH) as cnx:
@@ -197,7 +934,7 @@ class NiureadRecommender(object):
         #         cnx.commit()
 
     def test_query(self, query):
-        with MyConnection(option_files=self.CONFIG_FILE_PATH) as cnx:
+        with self.connect() as cnx:
             with MyCursor(cnx, buffered=True) as cursor:
                 print(query)
                 cursor.execute(query)
@@ -205,13 +942,137 @@ class NiureadRecommender(object):
                 print("finished")
 
 
+POOL_LOCK = threading.Lock()  # of the creation of the connection pools
+CONNECTION_SETTINGS = ("CONFIG_FILE_PATH", "POOL_SIZE", "PUSH_WITH_LOAD_DATA")  # the pool is made with them
+RECOMMENDATION_DTYPE = np.dtype([("id", np.int64),
+                                 ("userInfoId", np.int64),
+                                 ("bookInfoId", np.int64),
+                                 ("RecommendedDate", "U10"),
+                                 ("calculatedScore", np.float64)])
+
+
+class Segment(object):
+    """
+    a subset of the books and users that gets a model of its own, see NiureadRecommender.recommend_segments
+
+    usage:
+        Segment("zh", book_filter=lambda books: books["language"] == "zh", NUM_FEATURES=20)
+    """
+    def __init__(self, name, book_filter=None, user_filter=None, **settings):
+        """
+
+        @param name: names the model file, the factor store and the instrumentation of the segment
+        @param book_filter: a function of the books DataFrame returned by get_books, with the columns of
+                            BOOK_SEGMENT_COLUMNS, that returns a boolean mask of the books in the segment.
+                            None for all the books
+        @param user_filter: the same for the users, with the columns of USER_SEGMENT_COLUMNS
+        @param settings: class attributes of NiureadRecommender overridden for the segment,
+                         DB_NAME to read the tables of another database
+        """
+        self.name = name
+        self.book_filter = book_filter
+        self.user_filter = user_filter
+        self.settings = settings
+
+    def select(self, books, users):
+        """
+        @param books: see get_books
+        @param users: see get_users
+        @return: the indexes of the books and of the users in the segment
+        """
+        book_index = np.arange(books.shape[0]) if self.book_filter is None else \
+            np.flatnonzero(np.asarray(self.book_filter(books), dtype=bool))
+        user_index = np.arange(users.shape[0]) if self.user_filter is None else \
+            np.flatnonzero(np.asarray(self.user_filter(users), dtype=bool))
+
+        return book_index, user_index
+
+
+class BackgroundWriter(object):
+    """
+    pushes blocks of recommendations from a thread with a connection of its own, so the writes overlap with
+    the scoring of the next blocks. each block is committed once it is written, see write_recommendations.
+    the connection is only taken when the first block arrives, so it is not held while the model trains
+    """
+    def __init__(self, recommender, queue_size):
+        """
+
+        @param recommender: a NiureadRecommender, its connect and push settings are used
+        @param queue_size: number of blocks waiting to be written before put waits
+        """
+        self.recommender = recommender
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.rows_written = 0
+        self.thread = threading.Thread(target=self.run, name="niuread-writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        recommender = self.recommender
+        try:
+            block = self.queue.get()
+            if block is None:
+                return
+            with recommender.connect() as cnx:
+                while block is not None:
+                    if recommender.PUSH_WITH_LOAD_DATA:
+                        recommender.load_recommendations(cnx, block)
+                    else:
+                        recommender.write_recommendations(cnx, block, recommender.PUSH_BATCH_SIZE)
+                    self.rows_written += len(block)
+                    block = self.queue.get()
+        except Exception as e:
+            self.error = e
+            # keep taking the blocks, so put never waits for a writer that stopped
+            while block is not None:
+                block = self.queue.get()
+
+    def put(self, recommendations):
+        """
+        @param recommendations: a block of recommendations, see push_recommendations
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(recommendations)
+
+    def close(self):
+        """
+        wait for the blocks that are queued to be written
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        logging.info("pushed {} recommendations".format(self.rows_written))
+
+
+def train_segment(recommender, book_ids, douban, user_ids, indexed_rating, indexed_recommendation):
+    """
+    worker of recommend_segments, runs in another process when SEGMENT_JOBS > 1
+
+    @param recommender: the recommender of the segment, see NiureadRecommender.for_segment
+    @return: the recommendations, and the stages and counters of the segment
+    """
+    recommendations = recommender.train_and_score(book_ids, douban, user_ids, indexed_rating, indexed_recommendation)
+
+    return recommendations, recommender.instrumentation.stages, recommender.instrumentation.counters
+
+
 class MyConnection(object):
     """
     this class is a wrapper of mysql.connector.connection.MySQLConnection,
     to enable the use of "with statement"
+
+    if a mysql.connector.pooling.MySQLConnectionPool is given, the connection is taken from the pool and
+    is given back to it on exit
     """
-    def __init__(self, *args, **kwargs):
-        self.cnx = mysql.connector.connect(*args, **kwargs)
+    def __init__(self, *args, pool=None, **kwargs):
+        if pool is None:
+            import mysql.connector
+            self.cnx = mysql.connector.connect(*args, **kwargs)
+        else:
+            self.cnx = pool.get_connection()
+            self.cnx.ping(reconnect=True)  # health check, a pooled connection may have been dropped by the server
 
     def __enter__(self):
         logging.debug("MySQL connection entered")
@@ -227,7 +1088,7 @@ class MyCursor(object):
     this class is a wrapper of mysql.connector.cursor.MySQLCursor,
     to enable the use of "with statement"
     """
-    def __init__(self, cnx: mysql.connector.connection.MySQLConnection, *args, **kwargs):
+    def __init__(self, cnx: "mysql.connector.connection.MySQLConnection", *args, **kwargs):
         self.cursor = cnx.cursor(*args, **kwargs)
 
     def __enter__(self):
@@ -239,6 +1100,98 @@ class MyCursor(object):
         logging.debug("MySQL cursor closed")
 
 
+def id_lookup(ids):
+    """
+    build an array that maps ids to indexes, lookup[ids[i]] == i, and -1 for ids that are not in ids
+
+    @param ids: non-negative integer ids
+    @return:
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    lookup = np.full(ids.max() + 1 if ids.size else 0, -1, dtype=np.int64)
+    lookup[ids] = np.arange(ids.size)
+
+    return lookup
+
+
+def lookup_index(lookup, ids):
+    """
+    map ids to indexes with a lookup built by id_lookup, unknown ids are mapped to -1
+
+    @param lookup:
+    @param ids:
+    @return:
+    """
+    index = np.full(ids.shape, -1, dtype=np.int64)
+    known = (ids >= 0) & (ids < lookup.size)
+    index[known] = lookup[ids[known]]
+
+    return index
+
+
+def index_rows(rows, book_lookup, user_lookup):
+    """
+    map the bookInfoId and userInfoId in the first two columns to indexes, rows of unknown books or users are dropped
+
+    @param rows: an integer array of shape (n, k)
+    @param book_lookup: see id_lookup
+    @param user_lookup: see id_lookup
+    @return: a new array of shape (m, k)
+    """
+    indexed = np.array(rows, dtype=np.int64)
+    indexed[:, 0] = lookup_index(book_lookup, indexed[:, 0])
+    indexed[:, 1] = lookup_index(user_lookup, indexed[:, 1])
+
+    return indexed[(indexed[:, 0] >= 0) & (indexed[:, 1] >= 0)]
+
+
+def douban_prior(all_douban):
+    """
+    rescale douban scores to the rating scale of the users, books without a valid douban score get 2.5
+
+    @param all_douban: doubanScore of each book, may contain nan
+    @return: an array of shape (num_books, 1)
+    """
+    scaled = (np.asarray(all_douban, dtype=np.float64) - 1)/9*4 + 1
+    # nan compares false, so it is not valid either
+    valid_douban = np.where(scaled >= 1, scaled, 2.5)
+
+    return valid_douban.reshape((-1, 1))
+
+
+def assemble_recommendations(user_ids, book_ids, prediction, score, date):
+    """
+    build the rows of the recommendation history table with array operations
+
+    @param user_ids: userInfoId of each user index
+    @param book_ids: bookInfoId of each book index
+    @param prediction: book indexes of shape (num_users, k), as returned by predict_top_k
+    @param score: scores of shape (num_users, k), entries that are not finite are left out
+    @param date: RecommendedDate of all rows
+    @return: a structured array of RECOMMENDATION_DTYPE, one row per recommendation
+    """
+    valid = np.isfinite(score)
+    recommendations = np.zeros(np.count_nonzero(valid), dtype=RECOMMENDATION_DTYPE)
+    recommendations["userInfoId"] = np.broadcast_to(np.reshape(user_ids, (-1, 1)), score.shape)[valid]
+    recommendations["bookInfoId"] = np.asarray(book_ids)[prediction[valid]]
+    recommendations["RecommendedDate"] = date
+    recommendations["calculatedScore"] = score[valid]
+
+    return recommendations
+
+
+def to_sql_rows(rows):
+    """
+    convert numpy scalars in the rows to python values, which mysql.connector can bind as parameters
+
+    @param rows: a structured array or a sequence of tuples
+    @return: a list of tuples
+    """
+    if isinstance(rows, np.ndarray):
+        return rows.tolist()
+    return [tuple(v.item() if isinstance(v, np.generic) else v for v in row) for row in rows]
+
+
 def main():
     logging.basicConfig(level=logging.DEBUG)
     nr = NiureadRecommender()
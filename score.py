@@ -0,0 +1,39 @@
+"""
+score users or books from the factors saved by the last run, without the database.
+only numpy is imported, see factor_store
+
+usage:
+    python score.py [--store DIRECTORY] [-k K] [--n-probe N] USER_ID [USER_ID ...]
+    python score.py [--store DIRECTORY] [-k K] --similar BOOK_ID
+"""
+
+__author__ = 'Antares'
+
+import argparse
+from factor_store import FactorStore
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="score from the saved factors")
+    parser.add_argument("ids", nargs="+", type=int, help="userInfoId, or bookInfoId with --similar")
+    parser.add_argument("--store", default="factor_store", help="directory of the factor store")
+    parser.add_argument("-k", type=int, default=10, help="number of books per id")
+    parser.add_argument("--n-probe", type=int, help="lists probed by the approximate index, if the store has one")
+    parser.add_argument("--similar", action="store_true", help="find the books most like the given books")
+    args = parser.parse_args(argv)
+
+    try:
+        store = FactorStore(args.store, cache_size=0, n_probe=args.n_probe)
+    except OSError as e:
+        parser.error("no factor store in {}: {}".format(args.store, e))
+    for i in args.ids:
+        try:
+            book_ids, scores = store.more_like_this(i, args.k) if args.similar else store.top_k(i, args.k)
+        except KeyError as e:
+            parser.error(e.args[0])
+        for book_id, score in zip(book_ids, scores):
+            print("{}\t{}\t{:.6f}".format(i, book_id, score))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+hyperparameter sweep of NiureadRecommender on a validation split of the ratings.
+the ratings are read and the biases computed once, the trials run in parallel processes,
+and nothing is written to the database
+
+usage:
+    python sweep.py NUM_FEATURES=5,10,20 REGULATION_LAMBDA=0.1,0.5,2 --jobs 4
+    python sweep.py --random 20 NUM_FEATURES=5:40 REGULATION_LAMBDA=0.01:10.0
+"""
+
+__author__ = 'Antares'
+
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import itertools
+import concurrent.futures
+import numpy as np
+from collaborative_filtering import learn, rating_biases, to_triples, open_shared
+from niuread import NiureadRecommender, douban_prior
+
+PARAMETERS = ("NUM_FEATURES", "REGULATION_LAMBDA", "NUM_ITERATION")
+
+
+def split_ratings(indexed_rating, validation_fraction=0.1, seed=0):
+    """
+    @param indexed_rating: an array of (book_index, user_index, score) rows
+    @param validation_fraction:
+    @param seed:
+    @return: the training and the validation rows
+    """
+    validation = np.random.RandomState(seed).rand(indexed_rating.shape[0]) < validation_fraction
+
+    return indexed_rating[~validation], indexed_rating[validation]
+
+
+def grid(**values):
+    """
+    usage:
+        grid(NUM_FEATURES=[5, 10], REGULATION_LAMBDA=[0.1, 1])
+
+    @param values: a list of values of each parameter
+    @return: a list of the dicts of every combination
+    """
+    return [dict(zip(values, combination)) for combination in itertools.product(*values.values())]
+
+
+def random_search(n_trials, seed=0, **ranges):
+    """
+    usage:
+        random_search(20, NUM_FEATURES=(5, 40), REGULATION_LAMBDA=(0.01, 10.0), NUM_ITERATION=[50, 100])
+
+    @param n_trials:
+    @param seed:
+    @param ranges: a list to choose from, a (low, high) pair of ints drawn uniformly,
+                   or a (low, high) pair of floats drawn log-uniformly
+    @return: a list of n_trials dicts
+    """
+    rng = np.random.RandomState(seed)
+    trials = []
+    for _ in range(n_trials):
+        trial = {}
+        for name, values in ranges.items():
+            if isinstance(values, list):
+                trial[name] = values[rng.randint(len(values))]
+            elif isinstance(values[0], int):
+                trial[name] = int(rng.randint(values[0], values[1] + 1))
+            else:
+                trial[name] = float(np.exp(rng.uniform(np.log(values[0]), np.log(values[1]))))
+        trials.append(trial)
+
+    return trials
+
+
+def rmse(theta, x, y_mean, book_index, user_index, score, user_bias=None):
+    """
+    root mean squared error of the predictions x.dot(theta.T) + y_mean + user_bias on sparse ratings
+
+    @return:
+    """
+    if score.size == 0:
+        return float("nan")
+
+    prediction = np.einsum("ij,ij->i", x[book_index], theta[user_index]) + y_mean[book_index, 0]
+    if user_bias is not None:
+        prediction += user_bias[user_index, 0]
+
+    return float(np.sqrt(np.mean((prediction - score)**2)))
+
+
+class MedianStopping(object):
+    """
+    callback of learn that stops a trial whose cost is above the median cost of the finished trials
+    at the same iteration. only trials with the same REGULATION_LAMBDA are compared, the cost of
+    different lambdas is not on the same scale
+    """
+    def __init__(self, reference, min_iterations=10, margin=0.0):
+        """
+
+        @param reference: the cost curves of the finished trials to compare with
+        @param min_iterations: iterations before a trial may be stopped
+        @param margin: a trial is stopped when its cost > (1 + margin) * the median
+        """
+        self.reference = reference
+        self.min_iterations = min_iterations
+        self.margin = margin
+        self.curve = []
+        self.stopped = False
+
+    def __call__(self, i, cost, gradient_norm, n_evals):
+        self.curve.append(cost)
+        if (len(self.curve) < self.min_iterations) or (not self.reference):
+            return False
+
+        # a trial that converged early keeps its last cost
+        median = np.median([curve[min(len(self.curve), len(curve)) - 1] for curve in self.reference])
+        self.stopped = cost > (1 + self.margin)*median
+
+        return self.stopped
+
+
+def run_trial(parameters, settings, paths, shape, reference, min_iterations, margin, seed):
+    """
+    train on the shared training split and measure the rmse on the validation split, runs in a worker process
+
+    @param parameters: values of PARAMETERS of the trial
+    @param settings: the other settings of NiureadRecommender used by learn
+    @param paths: the .npy files of the training and validation (book_index, user_index, score),
+                  the item biases and the user biases, see rating_biases
+    @param shape: (num_books, num_users)
+    @param reference: see MedianStopping
+    @param min_iterations: see MedianStopping
+    @param margin: see MedianStopping
+    @param seed: seed of the initial factors, the same for every trial
+    @return: a dict of the parameters, rmse, train_rmse, seconds, iterations, stopped and curve
+    """
+    book_index, user_index, score, validation_book, validation_user, validation_score, item_bias, user_bias = \
+        [open_shared(path, mode="r") for path in paths]
+    num_books, num_users = shape
+    stopping = MedianStopping(reference, min_iterations, margin)
+
+    start = time.perf_counter()
+    np.random.seed(seed)
+    theta, x, y_mean, cost, reg_cost = learn(shape_theta=(num_users, parameters["NUM_FEATURES"]),
+                                             shape_x=(num_books, parameters["NUM_FEATURES"]),
+                                             y=(book_index, user_index, score),
+                                             r=None,
+                                             reg_lambda=parameters["REGULATION_LAMBDA"],
+                                             n_iter=parameters["NUM_ITERATION"],
+                                             engine=settings["ENGINE"],
+                                             tol=settings["TOLERANCE"],
+                                             gtol=settings["GRADIENT_TOLERANCE"],
+                                             max_time=settings["MAX_TRAINING_SECONDS"],
+                                             callback=stopping,
+                                             learning_rate=settings["LEARNING_RATE"],
+                                             batch_size=settings["BATCH_SIZE"],
+                                             dtype=settings["DTYPE"],
+                                             biases=(item_bias, user_bias))
+    seconds = time.perf_counter() - start
+
+    return dict(parameters,
+                rmse=rmse(theta, x, y_mean, validation_book, validation_user, validation_score, user_bias),
+                train_rmse=rmse(theta, x, y_mean, book_index, user_index, score, user_bias),
+                seconds=seconds,
+                iterations=len(stopping.curve),
+                stopped=stopping.stopped,
+                curve=stopping.curve)
+
+
+def sweep(trials, recommender=None, ratings=None, validation_fraction=0.1, n_jobs=1, min_iterations=10, margin=0.0,
+          seed=0):
+    """
+    run the trials and measure the validation rmse of each. trials run n_jobs at a time,
+    each compared with the trials that finished before it started, see MedianStopping
+
+    @param trials: dicts of values of PARAMETERS, the missing ones come from the recommender, see grid and random_search
+    @param recommender: a NiureadRecommender whose settings are the defaults of the trials
+    @param ratings: (num_books, num_users, indexed_rating), None to read them with recommender.ingest.
+                    the douban prior is only used when they are read
+    @param validation_fraction:
+    @param n_jobs: number of processes
+    @param min_iterations: see MedianStopping
+    @param margin: see MedianStopping
+    @param seed:
+    @return: the results of run_trial, sorted by rmse, the trials stopped early last
+    """
+    recommender = NiureadRecommender() if recommender is None else recommender
+    settings = {name: getattr(recommender, name) for name in PARAMETERS + (
+        "ENGINE", "TOLERANCE", "GRADIENT_TOLERANCE", "MAX_TRAINING_SECONDS", "LEARNING_RATE", "BATCH_SIZE", "DTYPE")}
+    prior = None
+    if ratings is None:
+        book_ids, douban, user_ids, indexed_rating, indexed_recommendation = recommender.ingest()
+        ratings = (book_ids.size, user_ids.size, indexed_rating)
+        prior = douban_prior(douban)
+    num_books, num_users, indexed_rating = ratings
+
+    # biases of the training split, computed once. the trials share the arrays through memory-mapped files
+    train, validation = split_ratings(indexed_rating, validation_fraction, seed)
+    item_bias, user_bias = rating_biases(train, num_books, num_users, prior=prior,
+                                         shrinkage=recommender.BIAS_SHRINKAGE,
+                                         user_shrinkage=recommender.USER_BIAS_SHRINKAGE)
+    if user_bias is None:
+        user_bias = np.zeros((num_users, 1))
+    book_index, user_index, score = to_triples(train)
+    validation_book, validation_user, validation_score = to_triples(validation)
+    directory = tempfile.mkdtemp(prefix="niuread_sweep_")
+    paths = []
+    for name, array in (("book_index", book_index), ("user_index", user_index), ("score", score),
+                        ("validation_book", validation_book), ("validation_user", validation_user),
+                        ("validation_score", validation_score), ("item_bias", item_bias),
+                        ("user_bias", user_bias)):
+        paths.append(os.path.join(directory, name + ".npy"))
+        np.save(paths[-1], array)
+
+    curves = {}
+    results = []
+    pending = [dict({name: settings[name] for name in PARAMETERS}, **trial) for trial in trials]
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            running = set()
+            while pending or running:
+                while pending and (len(running) < n_jobs):
+                    parameters = pending.pop(0)
+                    reference = list(curves.get(parameters["REGULATION_LAMBDA"], []))
+                    running.add(executor.submit(run_trial, parameters, settings, paths, (num_books, num_users),
+                                                reference, min_iterations, margin, seed))
+                done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results.append(result)
+                    if not result["stopped"]:
+                        curves.setdefault(result["REGULATION_LAMBDA"], []).append(result["curve"])
+                    logging.info("trial {}: rmse {:.4f}, {:.2f}s, {} iterations{}".format(
+                        {name: result[name] for name in PARAMETERS}, result["rmse"], result["seconds"],
+                        result["iterations"], ", stopped early" if result["stopped"] else ""))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return sorted(results, key=lambda result: (result["stopped"], result["rmse"]))
+
+
+def parse_values(text):
+    """
+    "5,10,20" -> [5, 10, 20], "5:40" -> (5, 40), "0.01:10.0" -> (0.01, 10.0)
+
+    @param text:
+    @return:
+    """
+    def number(value):
+        return float(value) if ("." in value) or ("e" in value) else int(value)
+
+    if ":" in text:
+        return tuple(number(value) for value in text.split(":"))
+
+    return [number(value) for value in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="hyperparameter sweep on a validation split, nothing is pushed")
+    parser.add_argument("parameters", nargs="+", help="NAME=values, values as 5,10,20 or low:high for --random")
+    parser.add_argument("--random", type=int, metavar="N", help="N random trials instead of the grid")
+    parser.add_argument("--validation", type=float, default=0.1, help="fraction of the ratings held out")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--min-iterations", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    values = {}
+    for parameter in args.parameters:
+        name, text = parameter.split("=")
+        if name not in PARAMETERS:
+            parser.error("unknown parameter {}, one of {}".format(name, ", ".join(PARAMETERS)))
+        values[name] = parse_values(text)
+    trials = grid(**values) if args.random is None else random_search(args.random, **values)
+
+    results = sweep(trials, validation_fraction=args.validation, n_jobs=args.jobs, min_iterations=args.min_iterations)
+    print("\t".join(PARAMETERS + ("rmse", "train_rmse", "seconds", "iterations", "stopped")))
+    for result in results:
+        print("\t".join(str(result[name]) for name in PARAMETERS) +
+              "\t{:.4f}\t{:.4f}\t{:.2f}\t{}\t{}".format(result["rmse"], result["train_rmse"], result["seconds"],
+                                                        result["iterations"], result["stopped"]))
+
+
+if __name__ == "__main__":
+    main()
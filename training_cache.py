@@ -0,0 +1,177 @@
+"""
+on-disk cache of the tables read for training, so a run only fetches what changed since the last one
+"""
+
+__author__ = 'Antares'
+
+import io
+import os
+import json
+import threading
+import numpy as np
+
+
+class TrainingCache(object):
+    """
+    a directory of .npy arrays, each stored with the key of the data it was made from.
+    the arrays are memory mapped when read, and rows can be appended to them in place.
+    different arrays can be written from different threads
+
+    layout of the directory:
+        state.json      name -> {"key": ..., "version": ...} of each array
+        <name>.npy      the array
+    """
+    STATE_FILE = "state.json"
+
+    def __init__(self, directory):
+        """
+
+        @param directory: created on first use
+        """
+        self.directory = directory
+        self.state = {}
+        self.lock = threading.Lock()  # of the state file
+        path = os.path.join(directory, self.STATE_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".npy")
+
+    def key(self, name):
+        """
+        @param name:
+        @return: the key the array was stored with, or None if it is not in the cache
+        """
+        if (name not in self.state) or (not os.path.exists(self.path(name))):
+            return None
+
+        return self.state[name]["key"]
+
+    def version(self, name):
+        """
+        the version of an array changes every time it is replaced, but not when rows are appended,
+        so arrays made from it can tell whether they only need the new rows
+
+        @param name:
+        @return:
+        """
+        return self.state[name]["version"] if name in self.state else 0
+
+    def load(self, name):
+        """
+        @param name:
+        @return: the array, memory mapped read-only
+        """
+        return load_mapped(self.path(name))
+
+    def replace(self, name, array, key):
+        """
+        @param name:
+        @param array:
+        @param key: anything json can store
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.path(name) + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(temp_path, self.path(name))
+        self.set_state(name, key, self.version(name) + 1)
+
+    def append(self, name, rows, key):
+        """
+        append rows along the first axis, without rewriting the rows already stored
+
+        @param name:
+        @param rows:
+        @param key: the key of the array after the rows are appended
+        """
+        append_npy(self.path(name), rows)
+        self.set_state(name, key, self.version(name))
+
+    def set_state(self, name, key, version):
+        with self.lock:
+            self.state[name] = dict(key=key, version=version)
+            path = os.path.join(self.directory, self.STATE_FILE)
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.state, f)
+            os.replace(path + ".tmp", path)
+
+
+def load_mapped(path):
+    """
+    np.load a .npy file memory mapped read-only, empty arrays are loaded normally since they can not be mapped
+
+    @param path:
+    @return:
+    """
+    with open(path, "rb") as f:
+        shape, fortran_order, dtype = read_array_header(f)
+    if 0 in shape:
+        return np.load(path)
+
+    return np.load(path, mmap_mode="r")
+
+
+def read_array_header(f, with_version=False):
+    """
+    read the magic string and the header of a .npy file, f is left at the start of the data
+
+    @param f: a file open in binary mode, at its start
+    @param with_version: also return the (major, minor) version of the format
+    @return: shape, fortran_order, dtype, and the version if with_version
+    """
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        header = np.lib.format.read_array_header_1_0(f)
+    elif version == (2, 0):
+        header = np.lib.format.read_array_header_2_0(f)
+    else:
+        raise ValueError("unsupported .npy format version {}".format(version))
+
+    return header + (version,) if with_version else header
+
+
+def append_npy(path, rows):
+    """
+    append rows to a C-ordered .npy file in place. only the header is rewritten,
+    the whole file is rewritten if the new shape does not fit in the old header
+
+    @param path:
+    @param rows: an array whose shape matches the stored one except on the first axis
+    """
+    with open(path, "r+b") as f:
+        shape, fortran_order, dtype, version = read_array_header(f, with_version=True)
+        header_size = f.tell()
+        rows = np.ascontiguousarray(rows, dtype=dtype)
+        if fortran_order or (rows.shape[1:] != shape[1:]):
+            raise ValueError("can not append rows of shape {} to {} array {}".format(
+                rows.shape, "a fortran ordered" if fortran_order else "an", shape))
+
+        new_shape = (shape[0] + rows.shape[0],) + tuple(shape[1:])
+        header = io.BytesIO()
+        write_array_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else \
+            np.lib.format.write_array_header_2_0
+        write_array_header(header, dict(descr=np.lib.format.dtype_to_descr(dtype), fortran_order=False,
+                                        shape=new_shape))
+        if len(header.getvalue()) == header_size:
+            # the rows go first, so the old shape is still valid if the write is interrupted
+            f.seek(0, os.SEEK_END)
+            f.write(rows.tobytes())
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+
+    array = np.concatenate((np.load(path), rows))
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+def main():
+    pass
+
+
+if __name__ == "__main__":
+    main()